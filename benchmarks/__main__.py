@@ -0,0 +1,74 @@
+import argparse
+import sys
+
+from darkwallet.gateway2 import loop
+from benchmarks.suite import BenchmarkSuite, compare, save, load
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python3 -m benchmarks",
+        description="Benchmark the daemon against a fake blockchain server.")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        default=list(BenchmarkSuite.scenarios),
+                        help="Scenarios to run (default: all of %s)" %
+                             ", ".join(BenchmarkSuite.scenarios))
+    parser.add_argument("--addresses", type=int, default=20,
+                        help="Wallet addresses with history")
+    parser.add_argument("--history", type=int, default=4,
+                        help="History entries per address")
+    parser.add_argument("--stealth-rows", dest="stealth_rows", type=int,
+                        default=1000, help="Rows returned by stealth queries")
+    parser.add_argument("--stealth-scans", dest="stealth_scans", type=int,
+                        default=3, help="Stealth scans to time")
+    parser.add_argument("--blocks", type=int, default=3,
+                        help="New blocks to sync")
+    parser.add_argument("--reorgs", type=int, default=2,
+                        help="Reorganizations to recover from")
+    parser.add_argument("--reorg-depth", dest="reorg_depth", type=int,
+                        default=3, help="Blocks replaced by each reorg")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="Requests per RPC scenario")
+    parser.add_argument("--sends", type=int, default=10,
+                        help="Payments to send")
+    parser.add_argument("--gap-limit", dest="gap_limit", type=int,
+                        default=20, help="Wallet gap limit")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds added to every server query")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="Seconds to wait for the wallet to sync")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic chain")
+    parser.add_argument("--port", type=int, default=18888,
+                        help="Port for the daemon")
+    parser.add_argument("--output", "-o", default="benchmark.json",
+                        help="File to write the results to")
+    parser.add_argument("--compare", "-c", default=None,
+                        help="Earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed slowdown before a regression")
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in BenchmarkSuite.scenarios:
+            parser.error("unknown scenario: %s" % scenario)
+    if "restore" not in args.scenarios:
+        # Everything else needs the restored account.
+        args.scenarios.insert(0, "restore")
+    return args
+
+def main():
+    args = parse_args()
+    suite = BenchmarkSuite(args)
+    results = loop.run_until_complete(suite.run())
+    save(args.output, args, results)
+    print("Results written to %s" % args.output)
+
+    if args.compare is None:
+        return 0
+    regressions = compare(results, load(args.compare), args.threshold)
+    for scenario, previous, current in regressions:
+        print("Regression: %s p50 %.2f ms -> %.2f ms" % (
+            scenario, previous, current), file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
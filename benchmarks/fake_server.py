@@ -0,0 +1,265 @@
+import asyncio
+import collections
+import enum
+import hashlib
+import random
+import struct
+import time
+
+from libbitcoin import bc
+from darkwallet.wallet import hd_private_key_to_address
+
+# Stands in for a libbitcoin server. The chain is made up from a seed,
+# but every header and transaction is properly serialized so the
+# daemon parses, signs and spends them as it would real ones.
+
+OutPoint = collections.namedtuple("OutPoint", ["hash", "index"])
+
+class ErrorCode(enum.Enum):
+    not_found = 3
+
+_base58_alphabet = \
+    "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def encode_address(address_hash, version=0x00):
+    data = bytes([version]) + address_hash
+    data += sha256d(data)[:4]
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = _base58_alphabet[remainder] + encoded
+    padding = len(data) - len(data.lstrip(b"\0"))
+    return "1" * padding + encoded
+
+def decode_address(address):
+    number = 0
+    for char in address:
+        number = number * 58 + _base58_alphabet.index(char)
+    data = number.to_bytes(25, "big")
+    assert sha256d(data[:21])[:4] == data[21:]
+    return data[1:21]
+
+def _var_int(number):
+    if number < 0xfd:
+        return struct.pack("<B", number)
+    elif number <= 0xffff:
+        return b"\xfd" + struct.pack("<H", number)
+    return b"\xfe" + struct.pack("<I", number)
+
+def _script(data):
+    return _var_int(len(data)) + data
+
+def p2kh_script(address_hash):
+    return b"\x76\xa9\x14" + address_hash + b"\x88\xac"
+
+def serialize_transaction(inputs, outputs):
+    # inputs: [(previous hash, previous index, script), ...]
+    # outputs: [(value, script), ...]
+    data = struct.pack("<I", 1) + _var_int(len(inputs))
+    for previous_hash, previous_index, script in inputs:
+        data += previous_hash + struct.pack("<I", previous_index)
+        data += _script(script) + struct.pack("<I", 0xffffffff)
+    data += _var_int(len(outputs))
+    for value, script in outputs:
+        data += struct.pack("<Q", value) + _script(script)
+    return data + struct.pack("<I", 0)
+
+def wallet_addresses(wordlist, number, pocket_index=0):
+    # Same derivation the daemon uses for a pocket's normal keys.
+    seed = bc.decode_mnemonic(wordlist).data
+    root_key = bc.HdPrivate.from_seed(seed, bc.HdPrivate.mainnet)
+    pocket_key = root_key.derive_private(
+        pocket_index + bc.hd_first_hardened_key)
+    return [hd_private_key_to_address(pocket_key.derive_private(
+                i + bc.hd_first_hardened_key), False)
+            for i in range(number)]
+
+class FakeChain:
+
+    def __init__(self, wordlist, addresses=20, history=4, stealth_rows=1000,
+                 blocks=200, start_height=450000, seed=0):
+        self._random = random.Random(seed)
+        self.start_height = start_height
+
+        # height: serialized header
+        self._headers = {}
+        # Transactions by hash in both byte orders.
+        self._transactions = {}
+        # address: [(output, spend), ...]
+        self._history = collections.defaultdict(list)
+        # (ephemeral key, address hash, tx hash, height)
+        self._stealth = []
+
+        self.broadcasts = []
+        # address: time history was last requested
+        self.history_requests = {}
+        self.requested_transactions = set()
+
+        self._tip = start_height - 1
+        for _ in range(blocks):
+            self._add_header()
+
+        self.addresses = wallet_addresses(wordlist, addresses)
+        self.wallet_transactions = set()
+        for address in self.addresses:
+            for i in range(history):
+                self._add_history(address, spent=(i % 2 == 1))
+
+        for _ in range(stealth_rows):
+            self._stealth.append((self._bytes(32), self._bytes(20),
+                                  self._bytes(32), self._random_height()))
+
+    @property
+    def height(self):
+        return self._tip
+
+    def _bytes(self, size):
+        return bytes(self._random.getrandbits(8) for _ in range(size))
+
+    def _random_height(self):
+        return self._random.randint(self.start_height, self._tip)
+
+    def _header(self, height, previous_hash):
+        return (struct.pack("<I", 4) + previous_hash + self._bytes(32) +
+                struct.pack("<III", 1500000000 + height * 600,
+                            0x1d00ffff, self._random.getrandbits(32)))
+
+    def _add_header(self):
+        previous = self._headers.get(self._tip)
+        previous_hash = self._bytes(32) if previous is None else \
+            sha256d(previous)
+        self._tip += 1
+        self._headers[self._tip] = self._header(self._tip, previous_hash)
+
+    def _add_transaction(self, inputs, outputs):
+        tx_data = serialize_transaction(inputs, outputs)
+        tx_hash = sha256d(tx_data)
+        self._transactions[tx_hash] = tx_data
+        self._transactions[tx_hash[::-1]] = tx_data
+        return tx_hash
+
+    def _add_history(self, address, spent=False, value=None, height=None):
+        if value is None:
+            value = self._random.randint(10000, 1000000)
+        if height is None:
+            height = self._random_height()
+        address_hash = decode_address(address)
+
+        tx_hash = self._add_transaction(
+            [(self._bytes(32), 0, self._bytes(107))],
+            [(value, p2kh_script(address_hash)),
+             (self._random.randint(10000, 1000000),
+              p2kh_script(self._bytes(20)))])
+        self.wallet_transactions.add(tx_hash)
+        output = (OutPoint(tx_hash, 0), height, value)
+
+        spend = None
+        if spent:
+            spend_height = self._random.randint(height, self._tip)
+            spend_hash = self._add_transaction(
+                [(tx_hash, 0, self._bytes(107))],
+                [(value - 1000, p2kh_script(self._bytes(20)))])
+            self.wallet_transactions.add(spend_hash)
+            spend = (OutPoint(spend_hash, 0), spend_height)
+
+        self._history[address].append((output, spend))
+        return value
+
+    def balance(self):
+        return sum(output[2] for history in self._history.values()
+                   for output, spend in history if spend is None)
+
+    # ------------------------------------------------
+    # Changing the chain.
+    # ------------------------------------------------
+
+    def add_block(self, address=None, value=None):
+        self._add_header()
+        if address is None:
+            return 0
+        return self._add_history(address, value=value, height=self._tip)
+
+    def reorganize(self, depth):
+        # Replace the top blocks with a competing branch.
+        fork_height = self._tip - depth
+        self._tip = fork_height
+        for _ in range(depth + 1):
+            self._add_header()
+
+    # ------------------------------------------------
+    # Server queries.
+    # ------------------------------------------------
+
+    def last_height(self):
+        return None, self._tip
+
+    def block_header(self, height):
+        if height not in self._headers or height > self._tip:
+            return ErrorCode.not_found, None
+        return None, self._headers[height]
+
+    def transaction(self, tx_hash):
+        tx_hash = bytes(tx_hash)
+        if tx_hash not in self._transactions:
+            return ErrorCode.not_found, None
+        self.requested_transactions.add(tx_hash)
+        self.requested_transactions.add(tx_hash[::-1])
+        return None, self._transactions[tx_hash]
+
+    def history(self, address):
+        self.history_requests[address] = time.time()
+        return None, list(self._history.get(address, []))
+
+    def stealth(self, prefix, from_height):
+        return None, [(ephemeral_key, address_hash, tx_hash)
+                      for ephemeral_key, address_hash, tx_hash, height
+                      in self._stealth if height >= from_height]
+
+    def broadcast(self, tx_data):
+        self.broadcasts.append(tx_data)
+        return None
+
+class FakeClient:
+
+    def __init__(self, chain, latency):
+        self._chain = chain
+        self._latency = latency
+
+    async def _reply(self, result):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        return result
+
+    async def last_height(self):
+        return await self._reply(self._chain.last_height())
+
+    async def block_header(self, height):
+        return await self._reply(self._chain.block_header(height))
+
+    async def transaction(self, tx_hash):
+        return await self._reply(self._chain.transaction(tx_hash))
+
+    async def history(self, address):
+        return await self._reply(self._chain.history(address))
+
+    async def stealth(self, prefix, from_height):
+        return await self._reply(self._chain.stealth(prefix, from_height))
+
+    async def broadcast(self, tx_data):
+        return await self._reply(self._chain.broadcast(tx_data))
+
+class FakeContext:
+
+    def __init__(self, chain, latency=0):
+        self._chain = chain
+        self._latency = latency
+
+    def Client(self, url, settings):
+        return FakeClient(self._chain, self._latency)
+
+    def stop(self):
+        pass
@@ -0,0 +1,268 @@
+import asyncio
+import configparser
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import websockets
+
+from darkwallet.gateway2 import Gateway
+from darkwallet.settings import Settings
+from darkwallet.wallet_control import ScanStealthProcess
+from benchmarks.fake_server import FakeChain, FakeContext, encode_address
+
+# BIP39 test vector. Any valid wordlist works.
+WORDLIST = ["abandon"] * 11 + ["about"]
+ACCOUNT_NAME = "benchmark"
+PASSWORD = "benchmark-password"
+
+def _percentile(samples, fraction):
+    samples = sorted(samples)
+    index = min(int(fraction * len(samples)), len(samples) - 1)
+    return samples[index]
+
+def summarize(latencies, items=None):
+    # Latencies in seconds. Items is the amount of work done, which
+    # defaults to one per sample.
+    total = sum(latencies)
+    if items is None:
+        items = len(latencies)
+    return {
+        "count": len(latencies),
+        "total_seconds": total,
+        "throughput": items / total if total else None,
+        "mean_ms": total / len(latencies) * 1000,
+        "p50_ms": _percentile(latencies, 0.5) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000
+    }
+
+class BenchmarkError(Exception):
+    pass
+
+class Connection:
+
+    def __init__(self, websocket):
+        self._websocket = websocket
+        self._next_id = 0
+
+    async def query(self, command, *params):
+        self._next_id += 1
+        request = {
+            "command": command,
+            "id": self._next_id,
+            "params": params
+        }
+        await self._websocket.send(json.dumps(request))
+        response = json.loads(await self._websocket.recv())
+        assert response["id"] == request["id"]
+        return response["error"], response["result"]
+
+    async def timed_query(self, command, *params):
+        start = time.time()
+        ec, result = await self.query(command, *params)
+        if ec:
+            raise BenchmarkError("%s failed: %s" % (command, ec))
+        return time.time() - start, result
+
+class BenchmarkSuite:
+
+    scenarios = ("restore", "sync", "reorg", "balance", "history", "send",
+                 "stealth")
+
+    def __init__(self, args):
+        self._args = args
+        self._chain = FakeChain(WORDLIST, args.addresses, args.history,
+                                args.stealth_rows, seed=args.seed)
+        self._expected_balance = self._chain.balance()
+        self._random = random.Random(args.seed)
+
+    def _write_config(self, config_path):
+        # Start from the shipped config with the benchmark's overrides.
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), "darkwallet.cfg"))
+        config["main"]["port"] = str(self._args.port)
+        config["main"]["metrics-port"] = "0"
+        config["wallet"]["gap-limit"] = str(self._args.gap_limit)
+        config["blockchain-server"]["url"] = "fake://benchmark"
+        config["blockchain-server"]["chain-cache-size"] = "0"
+        config.remove_option("blockchain-server", "socks5")
+        darkwallet_cfg = os.path.join(config_path, "darkwallet.cfg")
+        with open(darkwallet_cfg, "w") as config_file:
+            config.write(config_file)
+
+    async def run(self):
+        config_path = tempfile.mkdtemp(prefix="darkwallet-benchmark-")
+        try:
+            self._write_config(config_path)
+            settings = Settings()
+            settings.load(["--config", config_path])
+
+            context = FakeContext(self._chain, self._args.latency)
+            self._gateway = Gateway(settings, context)
+            server = await self._gateway.serve()
+
+            path = "ws://localhost:%s" % self._args.port
+            results = {}
+            async with websockets.connect(path) as websocket:
+                connection = Connection(websocket)
+                for scenario in self.scenarios:
+                    if scenario not in self._args.scenarios:
+                        continue
+                    print("Running %s..." % scenario)
+                    method = getattr(self, "_" + scenario)
+                    results[scenario] = await method(connection)
+                    print(json.dumps(results[scenario], indent=2))
+
+            server.close()
+            await server.wait_closed()
+            self._gateway.stop()
+        finally:
+            shutil.rmtree(config_path)
+        return results
+
+    async def _wait_until(self, condition, description):
+        start = time.time()
+        while not await condition():
+            if time.time() - start > self._args.timeout:
+                raise BenchmarkError("Timed out waiting for %s." %
+                                     description)
+            await asyncio.sleep(0.01)
+        return time.time() - start
+
+    async def _balance_is(self, connection, value):
+        ec, result = await connection.query("dw_balance", None)
+        return not ec and result[0] == value
+
+    async def _synced(self, connection, since=0):
+        # Every address rescanned and the balance matching the chain.
+        for address in self._chain.addresses:
+            if self._chain.history_requests.get(address, -1) < since:
+                return False
+        return await self._balance_is(connection, self._expected_balance)
+
+    # ------------------------------------------------
+    # Scenarios.
+    # ------------------------------------------------
+
+    async def _restore(self, connection):
+        start = time.time()
+        ec, _ = await connection.query("dw_restore_account", ACCOUNT_NAME,
+                                       WORDLIST, PASSWORD, False)
+        if ec:
+            raise BenchmarkError("Restore failed: %s" % ec)
+        await self._wait_until(lambda: self._synced(connection),
+                               "the restore to finish")
+        duration = time.time() - start
+
+        # Sending needs every previous transaction cached.
+        await self._wait_until(self._transactions_cached,
+                               "the transaction cache to fill")
+        result = summarize([duration], len(self._chain.addresses))
+        result["cache_filled_seconds"] = time.time() - start
+        return result
+
+    async def _transactions_cached(self):
+        return self._chain.wallet_transactions <= \
+            self._chain.requested_transactions
+
+    async def _sync(self, connection):
+        latencies = []
+        for _ in range(self._args.blocks):
+            address = self._random.choice(self._chain.addresses)
+            self._expected_balance += self._chain.add_block(address)
+            start = time.time()
+            await self._wait_until(
+                lambda: self._synced(connection, start), "a new block")
+            latencies.append(time.time() - start)
+        return summarize(latencies)
+
+    async def _reorg(self, connection):
+        latencies = []
+        for _ in range(self._args.reorgs):
+            self._chain.reorganize(self._args.reorg_depth)
+            start = time.time()
+            await self._wait_until(
+                lambda: self._synced(connection, start),
+                "the wallet to recover from a reorg")
+            latencies.append(time.time() - start)
+        return summarize(latencies)
+
+    async def _repeat(self, connection, command, *params):
+        latencies = []
+        for _ in range(self._args.requests):
+            latency, _ = await connection.timed_query(command, *params)
+            latencies.append(latency)
+        return summarize(latencies)
+
+    async def _balance(self, connection):
+        return await self._repeat(connection, "dw_balance", None)
+
+    async def _history(self, connection):
+        return await self._repeat(connection, "dw_history", None)
+
+    async def _send(self, connection):
+        await self._wait_until(self._transactions_cached,
+                               "the transaction cache to fill")
+        latencies = []
+        for _ in range(self._args.sends):
+            address = encode_address(bytes(
+                self._random.getrandbits(8) for _ in range(20)))
+            latency, _ = await connection.timed_query(
+                "dw_send", [[address, 5000]], None, None)
+            latencies.append(latency)
+        return summarize(latencies)
+
+    async def _stealth(self, connection):
+        # Times the scan itself, inside the daemon, against every row.
+        wallet = self._gateway._wallet._wallet
+        ec, account = wallet._get_account(None)
+        assert ec is None
+        process = [process for process in account._controller._procs
+                   if isinstance(process, ScanStealthProcess)][0]
+        latencies = []
+        for _ in range(self._args.stealth_scans):
+            start = time.time()
+            await process._query_stealth(self._chain.start_height)
+            latencies.append(time.time() - start)
+        return summarize(latencies, self._args.stealth_rows * len(latencies))
+
+def compare(results, baseline, threshold):
+    # Lists scenarios whose median got slower by more than threshold.
+    regressions = []
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        previous = baseline[scenario]["p50_ms"]
+        current = result["p50_ms"]
+        if previous and (current - previous) / previous > threshold:
+            regressions.append((scenario, previous, current))
+    return regressions
+
+def save(filename, args, results):
+    report = {
+        "created": datetime.datetime.now().isoformat(),
+        "parameters": {
+            "addresses": args.addresses,
+            "history": args.history,
+            "stealth_rows": args.stealth_rows,
+            "blocks": args.blocks,
+            "reorgs": args.reorgs,
+            "reorg_depth": args.reorg_depth,
+            "latency": args.latency,
+            "seed": args.seed
+        },
+        "results": results
+    }
+    with open(filename, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+def load(filename):
+    with open(filename) as report_file:
+        return json.load(report_file)["results"]
@@ -18,6 +18,13 @@ class ErrorCode(enum.Enum):
     invalid_address = 7
     short_password = 8
     updating_history = 9
+    account_not_open = 10
+    invalid_format = 11
+    invalid_fee_rate = 12
+    bad_parameters = 13
+    # From the daemon's blockchain server pool.
+    timeout = 14
+    circuit_open = 15
 
 def create_random_id():
     MAX_UINT32 = 4294967295
@@ -33,12 +40,16 @@ def btc_to_satoshi(btc):
 
 class WebSocket:
 
-    def __init__(self, websockets_path):
+    def __init__(self, websockets_path, account=None):
         self._websocket_connect = websockets.connect(websockets_path)
         self._websocket = None
+        # Target account for queries. None uses the active account.
+        self._account = account
 
         # int id: future
         self._requests = {}
+        # int id: queue of responses for streamed queries
+        self._streams = {}
 
     async def __aenter__(self):
         self._websocket = await self._websocket_connect.__aenter__()
@@ -59,6 +70,9 @@ class WebSocket:
         message = json.loads(message)
         # Process the message.
         ident = message["id"]
+        if ident in self._streams:
+            self._streams[ident].put_nowait(message)
+            return
         future = self._requests[ident]
         del self._requests[ident]
         future.set_result(message)
@@ -72,6 +86,8 @@ class WebSocket:
             "id": ident,
             "params": params
         }
+        if self._account is not None:
+            request["account"] = self._account
         #print("Sending:", request)
         await self._produce(request)
         response = await future
@@ -83,6 +99,31 @@ class WebSocket:
             ec = ErrorCode[ec]
         return ec, response["result"]
 
+    async def stream(self, command, *params):
+        # Yields (ec, result) for each response until the last one.
+        ident = create_random_id()
+        queue = asyncio.Queue()
+        self._streams[ident] = queue
+        request = {
+            "command": command,
+            "id": ident,
+            "params": params
+        }
+        if self._account is not None:
+            request["account"] = self._account
+        await self._produce(request)
+        try:
+            while True:
+                response = await queue.get()
+                ec = response["error"]
+                if ec is not None:
+                    ec = ErrorCode[ec]
+                yield ec, response["result"]
+                if ec or not response.get("more"):
+                    return
+        finally:
+            del self._streams[ident]
+
     async def _produce(self, message):
         message = json.dumps(message)
         await self._websocket.send(message)
@@ -122,11 +163,26 @@ class Account:
         assert ec is None
         return params
 
+    @staticmethod
+    async def list_open(ws):
+        ec, params = await ws.query("dw_list_open_accounts")
+        assert ec is None
+        return params[0]
+
+    @staticmethod
+    async def close(ws, name):
+        ec, params = await ws.query("dw_close_account", name)
+        if ec:
+            assert ec in (ErrorCode.account_not_open,)
+            return ec
+        return None
+
     @staticmethod
     async def seed(ws):
         ec, params = await ws.query("dw_seed")
         if ec:
-            assert ec in (ErrorCode.no_active_account_set,)
+            assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open)
             return ec, None
         return None, params
 
@@ -138,6 +194,7 @@ class Pocket:
                                     name)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.duplicate)
             return ec
         return None
@@ -146,18 +203,30 @@ class Pocket:
     async def list(ws):
         ec, params = await ws.query("dw_list_pockets")
         if ec:
-            assert ec in (ErrorCode.no_active_account_set,)
+            assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open)
             return ec, []
         return None, params[0]
 
 class Wallet:
 
+    @staticmethod
+    async def restore_status(ws):
+        ec, params = await ws.query("dw_restore_status")
+        if ec:
+            assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
+                          ErrorCode.not_found)
+            return ec, None
+        return None, params[0]
+
     @staticmethod
     async def balance(ws, pocket=None):
         ec, params = await ws.query("dw_balance",
                                     pocket)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.updating_history)
             return ec, None
         return None, satoshi_to_btc(params[0])
@@ -168,6 +237,7 @@ class Wallet:
                                     pocket)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.updating_history)
             return ec, []
         return None, params
@@ -175,14 +245,104 @@ class Wallet:
     @staticmethod
     async def send(ws, dests, pocket=None, fee=None):
         dests = [(addr, btc_to_satoshi(amount)) for addr, amount in dests]
-        fee = btc_to_satoshi(fee)
+        # No fee lets the daemon pay its configured fee rate.
+        if fee is not None:
+            fee = btc_to_satoshi(fee)
         ec, params = await ws.query("dw_send",
                                     dests, pocket, fee)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.updating_history,
                           ErrorCode.invalid_address,
-                          ErrorCode.not_enough_funds)
+                          ErrorCode.not_enough_funds,
+                          ErrorCode.timeout,
+                          ErrorCode.circuit_open)
+            return ec, None
+        return None, params[0]
+
+    @staticmethod
+    async def export_history(ws, output, pocket=None, format="csv"):
+        # Writes the export to output as it arrives.
+        async for ec, params in ws.stream("dw_export_history",
+                                          pocket, format, False):
+            if ec:
+                assert ec in (ErrorCode.no_active_account_set,
+                              ErrorCode.account_not_open,
+                              ErrorCode.updating_history,
+                              ErrorCode.invalid_format,
+                              ErrorCode.not_found,
+                              ErrorCode.bad_parameters)
+                return ec
+            for chunk in params:
+                output.write(chunk)
+        return None
+
+    @staticmethod
+    async def export_history_to_file(ws, pocket=None, format="csv"):
+        # The daemon writes the file under its config path.
+        async for ec, params in ws.stream("dw_export_history",
+                                          pocket, format, True):
+            if ec:
+                assert ec in (ErrorCode.no_active_account_set,
+                              ErrorCode.account_not_open,
+                              ErrorCode.updating_history,
+                              ErrorCode.invalid_format,
+                              ErrorCode.not_found,
+                              ErrorCode.bad_parameters)
+                return ec, None
+            return None, params[0]
+
+    @staticmethod
+    async def queue_payment(ws, dests, pocket=None):
+        dests = [(addr, btc_to_satoshi(amount)) for addr, amount in dests]
+        ec, params = await ws.query("dw_queue_payment",
+                                    dests, pocket)
+        if ec:
+            assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
+                          ErrorCode.invalid_address,
+                          ErrorCode.not_found)
+            return ec, None
+        return None, params[0]
+
+    @staticmethod
+    async def queued_payments(ws):
+        ec, params = await ws.query("dw_queued_payments")
+        if ec:
+            assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open)
+            return ec, None
+        queued_payments = []
+        for payout in params:
+            queued_payments.append({
+                "address": payout["address"],
+                "value": satoshi_to_btc(payout["value"]),
+                "pocket": payout["pocket"],
+                "created_date": payout["created_date"]
+            })
+        return None, queued_payments
+
+    @staticmethod
+    async def flush_payments(ws):
+        ec, params = await ws.query("dw_flush_payments")
+        if ec:
+            return ec, None
+        return None, params
+
+    @staticmethod
+    async def consolidate(ws, pocket, fee_rate=None):
+        ec, params = await ws.query("dw_consolidate",
+                                    pocket, fee_rate)
+        if ec:
+            assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
+                          ErrorCode.updating_history,
+                          ErrorCode.not_found,
+                          ErrorCode.not_enough_funds,
+                          ErrorCode.invalid_fee_rate,
+                          ErrorCode.timeout,
+                          ErrorCode.circuit_open)
             return ec, None
         return None, params[0]
 
@@ -192,6 +352,7 @@ class Wallet:
                                     pocket)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.not_found)
             return ec, None
         pending_payments = []
@@ -213,6 +374,7 @@ class Wallet:
                                     pocket)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.not_found)
             return ec, []
         return None, params[0]
@@ -223,6 +385,7 @@ class Wallet:
                                     pocket)
         if ec:
             assert ec in (ErrorCode.no_active_account_set,
+                          ErrorCode.account_not_open,
                           ErrorCode.not_found)
             return ec, None
         return None, params[0]
@@ -236,6 +399,20 @@ class Daemon:
         assert ec is None
         return params[0]
 
+    @staticmethod
+    async def validate_addresses(ws, addresses):
+        ec, params = await ws.query("dw_validate_addresses",
+                                    addresses)
+        assert ec is None
+        return params
+
+    @staticmethod
+    async def trace(ws, count, kinds=None, profile=False):
+        ec, params = await ws.query("dw_trace",
+                                    count, kinds, profile)
+        assert ec is None
+        return params[0]
+
     @staticmethod
     async def stop(ws):
         await ws.only_send("dw_stop")
@@ -29,7 +29,7 @@ async def init(args, websockets_path):
 
     is_testnet = args.testnet
 
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec = await api.Account.create(ws, account_name,
                                       password, is_testnet)
 
@@ -41,7 +41,7 @@ async def init(args, websockets_path):
     return 0
 
 async def seed(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, seed = await api.Account.seed(ws)
 
     if ec:
@@ -79,8 +79,21 @@ async def restore(args, websockets_path):
     print(response)
     return 0
 
+async def restore_status(args, websockets_path):
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
+        ec, status = await api.Wallet.restore_status(ws)
+    if ec:
+        print("Error: fetching restore status.", ec, file=sys.stderr)
+        return
+    print("%s: %s of %s addresses scanned, %s used, "
+          "%s of %s transactions fetched, %s errors (%.1f s)" % (
+              status["stage"], status["scanned"], status["addresses"],
+              status["used"], status["fetched"], status["transactions"],
+              status["errors"], status["seconds"]))
+    return 0
+
 async def balance(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, balance = await api.Wallet.balance(ws, args.pocket)
     if ec:
         print("Error: fetching balance.", ec, file=sys.stderr)
@@ -89,7 +102,7 @@ async def balance(args, websockets_path):
     return 0
 
 async def history(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, history = await api.Wallet.history(ws, args.pocket)
     if ec:
         print("Error: fetching history.", ec, file=sys.stderr)
@@ -97,17 +110,51 @@ async def history(args, websockets_path):
     print(json.dumps(history, indent=2))
     return 0
 
+async def export(args, websockets_path):
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
+        if args.on_daemon:
+            ec, filename = await api.Wallet.export_history_to_file(
+                ws, args.pocket, args.format)
+            if not ec:
+                print(filename)
+        elif args.output is None:
+            ec = await api.Wallet.export_history(
+                ws, sys.stdout, args.pocket, args.format)
+        else:
+            with open(args.output, "w") as output:
+                ec = await api.Wallet.export_history(
+                    ws, output, args.pocket, args.format)
+    if ec:
+        print("Error: exporting history.", ec, file=sys.stderr)
+        return
+    return 0
+
 async def account(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         active_account, account_names = await api.Account.list(ws)
+        open_accounts = await api.Account.list_open(ws)
 
     for name in account_names:
         if name == active_account:
             print("*", name)
+        elif name in open_accounts:
+            print("+", name)
         else:
             print(" ", name)
     return 0
 
+async def close(args, websockets_path):
+    assert args.account
+    account_name = args.account[0]
+
+    async with api.WebSocket(websockets_path) as ws:
+        ec = await api.Account.close(ws, account_name)
+
+    if ec:
+        print("Error: failed to close account.", ec, file=sys.stderr)
+        return -1
+    return 0
+
 async def dw_set(args, websockets_path):
     assert args.account
     account_name = args.account[0]
@@ -115,7 +162,7 @@ async def dw_set(args, websockets_path):
     #password = getpass.getpass()
     password = "surfing2"
 
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec = await api.Account.set(ws, account_name, password)
 
     return 0
@@ -143,7 +190,7 @@ async def pocket(args, websockets_path):
               file=sys.stderr)
         return -1
     if args.pocket is None:
-        async with api.WebSocket(websockets_path) as ws:
+        async with api.WebSocket(websockets_path, args.target_account) as ws:
             ec, pockets = await api.Pocket.list(ws)
         if ec:
             print("Error: unable to fetch pockets.", ec, file=sys.stderr)
@@ -159,7 +206,7 @@ async def pocket(args, websockets_path):
             ]
         })
     else:
-        async with api.WebSocket(websockets_path) as ws:
+        async with api.WebSocket(websockets_path, args.target_account) as ws:
             ec = await api.Pocket.create(ws, args.pocket)
         if ec:
             print("Error: unable to create pocket.", ec, file=sys.stderr)
@@ -173,7 +220,7 @@ async def send(args, websockets_path):
     address = args.address[0]
     amount = args.amount[0]
     dests = [(address, amount)]
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, tx_hash = await api.Wallet.send(ws, dests, args.pocket, args.fee)
     if ec:
         print("Error: sending funds.", ec, file=sys.stderr)
@@ -181,8 +228,52 @@ async def send(args, websockets_path):
     print(tx_hash)
     return 0
 
+async def queue(args, websockets_path):
+    if not args.address:
+        async with api.WebSocket(websockets_path, args.target_account) as ws:
+            ec, queued_payments = await api.Wallet.queued_payments(ws)
+        if ec:
+            print("Error: fetching queued payments.", ec, file=sys.stderr)
+            return -1
+        for payout in queued_payments:
+            print(payout["address"], payout["value"], payout["pocket"],
+                  payout["created_date"])
+        return 0
+
+    if not args.amount:
+        print("Error: missing amount.", file=sys.stderr)
+        return -1
+    dests = [(args.address, args.amount)]
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
+        ec, length = await api.Wallet.queue_payment(ws, dests, args.pocket)
+    if ec:
+        print("Error: queueing payment.", ec, file=sys.stderr)
+        return -1
+    print("%s payments queued." % length)
+    return 0
+
+async def flush(args, websockets_path):
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
+        ec, tx_hashes = await api.Wallet.flush_payments(ws)
+    if ec:
+        print("Error: flushing queued payments.", ec, file=sys.stderr)
+        return -1
+    for tx_hash in tx_hashes:
+        print(tx_hash)
+    return 0
+
+async def consolidate(args, websockets_path):
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
+        ec, tx_hash = await api.Wallet.consolidate(ws, args.pocket,
+                                                   args.fee_rate)
+    if ec:
+        print("Error: consolidating outputs.", ec, file=sys.stderr)
+        return -1
+    print(tx_hash)
+    return 0
+
 async def pending(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, pending_payments = \
             await api.Wallet.pending_payments(ws, args.pocket)
     if ec:
@@ -196,7 +287,7 @@ async def pending(args, websockets_path):
     return 0
 
 async def recv(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, addrs = await api.Wallet.receive(ws, args.pocket)
     if ec:
         print("Error: fetching receive addresses.", ec, file=sys.stderr)
@@ -206,7 +297,7 @@ async def recv(args, websockets_path):
     return 0
 
 async def stealth(args, websockets_path):
-    async with api.WebSocket(websockets_path) as ws:
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         ec, stealth_addr = await api.Wallet.stealth(ws, args.pocket)
     if ec:
         print("Error: fetching receive addresses.", ec, file=sys.stderr)
@@ -216,6 +307,12 @@ async def stealth(args, websockets_path):
 
 async def valid_addr(args, websockets_path):
     assert args.address
+    if len(args.address) > 1:
+        async with api.WebSocket(websockets_path) as ws:
+            types = await api.Daemon.validate_addresses(ws, args.address)
+        for address, address_type in zip(args.address, types):
+            print(address, address_type)
+        return 0
     message = json.dumps({
         "command": "dw_validate_address",
         "id": create_random_id(),
@@ -270,8 +367,16 @@ async def setting(args, websockets_path):
         response = json.loads(await websocket.recv())
     print(response)
 
-async def stop(args, websockets_path):
+async def trace(args, websockets_path):
+    kinds = None if args.kind is None else [args.kind]
     async with api.WebSocket(websockets_path) as ws:
+        directory = await api.Daemon.trace(ws, args.count, kinds,
+                                           args.profile)
+    print("Traces will be written to %s" % directory)
+    return 0
+
+async def stop(args, websockets_path):
+    async with api.WebSocket(websockets_path, args.target_account) as ws:
         await api.Daemon.stop(ws)
 
 async def main():
@@ -282,6 +387,10 @@ async def main():
     parser.add_argument("--port", "-p", dest="port",
                         help="Connect to daemon on the given port.",
                         default=None)
+    parser.add_argument("--account", "-a", dest="target_account",
+                        help="Run the command on this open account "
+                             "instead of the active one.",
+                        default=None)
     subparsers = parser.add_subparsers(help="sub-command help")
 
     parser_init = subparsers.add_parser("init", help="Create new account.")
@@ -305,6 +414,10 @@ async def main():
         help="Create a testnet account")
     parser_restore.set_defaults(func=restore)
 
+    parser_restore_status = subparsers.add_parser(
+        "restore_status", help="Show how far a restore has got")
+    parser_restore_status.set_defaults(func=restore_status)
+
     parser_balance = subparsers.add_parser("balance", help="Show balance")
     parser_balance.add_argument("pocket", nargs="?", metavar="POCKET",
                                 default=None, help="Pocket name")
@@ -315,6 +428,21 @@ async def main():
                                 default=None, help="Pocket name")
     parser_history.set_defaults(func=history)
 
+    parser_export = subparsers.add_parser(
+        "export", help="Export the full history for accounting")
+    parser_export.add_argument("pocket", nargs="?", metavar="POCKET",
+                               default=None, help="Pocket name")
+    parser_export.add_argument("--format", dest="format", default="csv",
+                               choices=("csv", "jsonl"),
+                               help="Output format (default: csv)")
+    parser_export.add_argument("--output", "-o", dest="output", default=None,
+                               help="File to write (default: stdout)")
+    parser_export.add_argument("--on-daemon", dest="on_daemon",
+                               action="store_true",
+                               help="Write the file under the daemon's "
+                                    "config path instead")
+    parser_export.set_defaults(func=export)
+
     parser_account = subparsers.add_parser("account", help="List accounts")
     parser_account.set_defaults(func=account)
 
@@ -323,6 +451,12 @@ async def main():
                             help="Account name")
     parser_set.set_defaults(func=dw_set)
 
+    parser_close = subparsers.add_parser("close",
+                                         help="Close an open account")
+    parser_close.add_argument("account", nargs=1, metavar="ACCOUNT",
+                              help="Account name")
+    parser_close.set_defaults(func=close)
+
     parser_rm = subparsers.add_parser("rm", help="Remove an account")
     parser_rm.add_argument("account", nargs=1, metavar="ACCOUNT",
                            help="Account name")
@@ -345,9 +479,33 @@ async def main():
     parser_send.add_argument("--pocket", "-p", dest="pocket",
                              help="Pocket name to send from", default=None)
     parser_send.add_argument("--fee", "-f", dest="fee", type=int,
-                             help="Fee to pay", default=0)
+                             help="Fee to pay (default: use the daemon's "
+                                  "fee rate)", default=None)
     parser_send.set_defaults(func=send)
 
+    parser_queue = subparsers.add_parser(
+        "queue", help="Queue a payment to send in the next batch")
+    parser_queue.add_argument("address", nargs="?", metavar="ADDRESS",
+                              help="Address to pay (default: list the queue)")
+    parser_queue.add_argument("amount", nargs="?", metavar="AMOUNT",
+                              help="Amount to pay")
+    parser_queue.add_argument("--pocket", "-p", dest="pocket",
+                              help="Pocket name to send from", default=None)
+    parser_queue.set_defaults(func=queue)
+
+    parser_flush = subparsers.add_parser(
+        "flush", help="Send all queued payments now")
+    parser_flush.set_defaults(func=flush)
+
+    parser_consolidate = subparsers.add_parser(
+        "consolidate", help="Merge small outputs in a pocket")
+    parser_consolidate.add_argument("pocket", metavar="POCKET",
+                                    help="Pocket name")
+    parser_consolidate.add_argument(
+        "--fee-rate", "-f", dest="fee_rate", type=int, default=None,
+        help="Satoshis per byte (default: fee-rate)")
+    parser_consolidate.set_defaults(func=consolidate)
+
     parser_pending = subparsers.add_parser("pending",
                                            help="Show pending_payments")
     parser_pending.add_argument("pocket", nargs="?", metavar="POCKET",
@@ -366,8 +524,8 @@ async def main():
     parser_stealth.set_defaults(func=stealth)
 
     parser_valid_addr = subparsers.add_parser("validate_address",
-        help="Validate a Bitcoin address")
-    parser_valid_addr.add_argument("address", nargs=1, metavar="ADDRESS",
+        help="Validate Bitcoin addresses")
+    parser_valid_addr.add_argument("address", nargs="+", metavar="ADDRESS",
                              help="Address for send in the format")
     parser_valid_addr.set_defaults(func=valid_addr)
 
@@ -383,6 +541,20 @@ async def main():
                                 default=None, help="Setting value")
     parser_setting.set_defaults(func=setting)
 
+    parser_trace = subparsers.add_parser(
+        "trace", help="Trace the next requests and process cycles")
+    parser_trace.add_argument("count", nargs="?", type=int, default=10,
+                              metavar="COUNT",
+                              help="Number to trace, or 0 to stop "
+                                   "(default: 10)")
+    parser_trace.add_argument("--kind", "-k", dest="kind", default=None,
+                              choices=("request", "process"),
+                              help="Only trace requests or processes")
+    parser_trace.add_argument("--profile", dest="profile",
+                              action="store_true",
+                              help="Also write cProfile dumps")
+    parser_trace.set_defaults(func=trace)
+
     parser_help = subparsers.add_parser("stop", help="Stop the daemon")
     parser_help.set_defaults(func=stop)
 
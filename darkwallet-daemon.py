@@ -1,12 +1,19 @@
 #!/usr/bin/python3
+import logging
 import sys
 
 import darkwallet
+import darkwallet.log
+
+logger = logging.getLogger("darkwallet.daemon")
 
 def main():
     # Load config file settings
     settings = darkwallet.Settings()
     settings.load()
+    darkwallet.log.setup(settings)
+    if settings.is_new_config:
+        logger.info("Initializing new darkwallet.cfg.")
 
     # Start the darkwallet-daemon
     if settings.use_tornado_impl:
@@ -1,3 +1,4 @@
+import functools
 from enum import Enum
 from libbitcoin import bc
 
@@ -14,55 +15,65 @@ class AddressValidator:
 
     def __init__(self, address):
         self._address = address
+        self._type, self._payment_address, self._stealth_address = \
+            _parse(address)
 
     def is_valid(self):
-        return self.type() != AddressType.invalid
+        return self._type != AddressType.invalid
 
     def is_mainnet(self):
-        return (self.type() == AddressType.mainnet_p2kh or
-                self.type() == AddressType.mainnet_p2sh)
+        return self._type in (AddressType.mainnet_p2kh,
+                              AddressType.mainnet_p2sh)
 
     def is_testnet(self):
-        return (self.type() == AddressType.testnet_p2kh or
-                self.type() == AddressType.testnet_p2sh)
+        return self._type in (AddressType.testnet_p2kh,
+                              AddressType.testnet_p2sh)
 
     def is_payment(self):
         return (self.is_mainnet() or self.is_testnet() or
-                self.type() == AddressType.other_payment)
+                self._type == AddressType.other_payment)
 
     def is_p2kh(self):
-        return (self.type() == AddressType.mainnet_p2kh or
-                self.type() == AddressType.testnet_p2kh)
+        return self._type in (AddressType.mainnet_p2kh,
+                              AddressType.testnet_p2kh)
 
     def is_p2sh(self):
-        return (self.type() == AddressType.mainnet_p2sh or
-                self.type() == AddressType.testnet_p2sh)
+        return self._type in (AddressType.mainnet_p2sh,
+                              AddressType.testnet_p2sh)
 
     def is_stealth(self):
-        return self.type() == AddressType.stealth
+        return self._type == AddressType.stealth
 
     def type(self):
-        if self.payment_address is not None:
-            payaddr = self.payment_address
-            if payaddr.version() == bc.PaymentAddress.mainnet_p2kh:
-                return AddressType.mainnet_p2kh
-            elif payaddr.version() == bc.PaymentAddress.mainnet_p2sh:
-                return AddressType.mainnet_p2sh
-            elif payaddr.version() == bc.PaymentAddress.testnet_p2kh:
-                return AddressType.testnet_p2kh
-            elif payaddr.version() == bc.PaymentAddress.testnet_p2sh:
-                return AddressType.testnet_p2sh
-            else:
-                return AddressType.other_payment
-        elif self.stealth_address is not None:
-            return AddressType.stealth
-        return AddressType.invalid
+        return self._type
 
     @property
     def payment_address(self):
-        return bc.PaymentAddress.from_string(self._address)
+        return self._payment_address
 
     @property
     def stealth_address(self):
-        return bc.StealthAddress.from_string(self._address)
+        return self._stealth_address
 
+_payment_types = {
+    bc.PaymentAddress.mainnet_p2kh: AddressType.mainnet_p2kh,
+    bc.PaymentAddress.mainnet_p2sh: AddressType.mainnet_p2sh,
+    bc.PaymentAddress.testnet_p2kh: AddressType.testnet_p2kh,
+    bc.PaymentAddress.testnet_p2sh: AddressType.testnet_p2sh
+}
+
+# The same payout addresses get validated over and over.
+@functools.lru_cache(maxsize=100000)
+def _parse(address):
+    payment_address = bc.PaymentAddress.from_string(address)
+    if payment_address is not None:
+        address_type = _payment_types.get(payment_address.version(),
+                                          AddressType.other_payment)
+        return address_type, payment_address, None
+    stealth_address = bc.StealthAddress.from_string(address)
+    if stealth_address is not None:
+        return AddressType.stealth, None, stealth_address
+    return AddressType.invalid, None, None
+
+def validate_addresses(addresses):
+    return [AddressValidator(address).type() for address in addresses]
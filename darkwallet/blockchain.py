@@ -0,0 +1,445 @@
+import asyncio
+import collections
+import enum
+import logging
+import os
+import random
+import time
+
+import libbitcoin.server
+from libbitcoin.server_fake_async import Client as FakeAsyncClient
+from darkwallet.chain_cache import ChainCache
+import darkwallet.metrics as metrics
+import darkwallet.tracing as tracing
+
+logger = logging.getLogger(__name__)
+
+class ErrorCode(enum.Enum):
+    timeout = 1
+    circuit_open = 2
+
+def _is_error(command, result):
+    # Broadcast only returns an error code.
+    ec = result if command == "broadcast" else result[0]
+    if not ec:
+        return False
+    # Not found is a valid answer, not a failing server.
+    return getattr(ec, "name", None) != "not_found"
+
+def _error_result(command, ec):
+    if command == "broadcast":
+        return ec
+    return ec, None
+
+class TimeoutClass:
+
+    # The timeout is a multiple of the slowest latencies seen
+    # for a command, kept within [minimum, maximum].
+    _multiplier = 3
+    _percentile = 0.99
+
+    def __init__(self, default, minimum, maximum):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def timeout(self, latencies):
+        latency = latencies.percentile(self._percentile)
+        if latency is None:
+            return self.default
+        timeout = latency * self._multiplier
+        return min(max(timeout, self.minimum), self.maximum)
+
+def _timeout_classes(query_expire_time):
+    fast = TimeoutClass(min(query_expire_time, 2), 0.5, 10)
+    normal = TimeoutClass(query_expire_time, 2, 60)
+    slow = TimeoutClass(max(query_expire_time, 120), 30, 600)
+    return {
+        "last_height": fast,
+        "block_header": fast,
+        "transaction": normal,
+        "history": normal,
+        "broadcast": normal,
+        "stealth": slow
+    }
+
+class LatencyTracker:
+
+    def __init__(self, size=100):
+        self._samples = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, latency):
+        self._samples.append(latency)
+
+    def percentile(self, fraction):
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        index = min(int(fraction * len(samples)), len(samples) - 1)
+        return samples[index]
+
+class CircuitBreaker:
+
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    # Trip when at least this share of the recent queries failed.
+    _max_error_rate = 0.5
+    _min_samples = 10
+    _min_open_time = 5
+    _max_open_time = 300
+
+    def __init__(self):
+        self.state = CircuitBreaker.closed
+        self._errors = collections.deque(maxlen=20)
+        self._open_time = self._min_open_time
+        self._opened_at = None
+
+    @property
+    def error_rate(self):
+        if not self._errors:
+            return 0
+        return sum(self._errors) / len(self._errors)
+
+    def allow(self):
+        if self.state != CircuitBreaker.open:
+            return True
+        if time.time() - self._opened_at < self._open_time:
+            return False
+        # Let queries through again until one decides the state.
+        self.state = CircuitBreaker.half_open
+        return True
+
+    def record(self, is_error):
+        if self.state == CircuitBreaker.half_open:
+            if is_error:
+                # Still failing so back off for longer.
+                self._open_time = min(self._open_time * 2,
+                                      self._max_open_time)
+                self._trip()
+            else:
+                self.state = CircuitBreaker.closed
+                self._open_time = self._min_open_time
+                self._errors.clear()
+            return
+
+        self._errors.append(is_error)
+        if (self.state == CircuitBreaker.closed and
+                len(self._errors) >= self._min_samples and
+                self.error_rate >= self._max_error_rate):
+            self._trip()
+
+    def _trip(self):
+        self.state = CircuitBreaker.open
+        self._opened_at = time.time()
+
+class ServerConnection:
+
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.in_flight = 0
+
+        self.breaker = CircuitBreaker()
+        self._latencies = collections.defaultdict(LatencyTracker)
+
+    def allow(self):
+        return self.breaker.allow()
+
+    def score(self, command):
+        latency = self._latencies[command].percentile(0.5) or 0
+        return latency * (1 + self.in_flight)
+
+    def hedge_delay(self, command, default):
+        return self._latencies[command].percentile(0.95) or default
+
+    def add_latency(self, command, latency):
+        self._latencies[command].add(latency)
+
+    def record(self, command, latency, is_error):
+        if not is_error:
+            self.add_latency(command, latency)
+
+        state = self.breaker.state
+        self.breaker.record(is_error)
+        if self.breaker.state != state:
+            logger.warning("Server %s circuit is now %s.",
+                           self.url, self.breaker.state)
+
+class ClientPool:
+
+    _min_hedge_delay = 0.05
+
+    def __init__(self, servers, query_expire_time):
+        self._servers = servers
+        self._timeout_classes = _timeout_classes(query_expire_time)
+        self._default_timeout_class = TimeoutClass(
+            query_expire_time, 2, 60)
+        # Observed latencies per command across all servers.
+        self._latencies = collections.defaultdict(LatencyTracker)
+
+    def supports(self, command):
+        return all(hasattr(server.client, command)
+                   for server in self._servers)
+
+    def timeout(self, command):
+        timeout_class = self._timeout_classes.get(
+            command, self._default_timeout_class)
+        return timeout_class.timeout(self._latencies[command])
+
+    def _ordered_servers(self, command):
+        servers = [server for server in self._servers if server.allow()]
+        # Shuffle first so equally scored servers share the load.
+        random.shuffle(servers)
+        return sorted(servers, key=lambda server: server.score(command))
+
+    async def query(self, command, *args):
+        servers = self._ordered_servers(command)
+        if not servers:
+            # Fail fast rather than wait on servers known to be down.
+            return _error_result(command, ErrorCode.circuit_open)
+
+        timeout = self.timeout(command)
+        tasks = {}
+        self._start(tasks, servers.pop(0), command, args, timeout)
+
+        while True:
+            # Hedge on the next server if this one is slower than usual.
+            delay = None
+            if servers:
+                server = list(tasks.values())[-1]
+                delay = max(self._min_hedge_delay,
+                            server.hedge_delay(command, timeout / 4))
+
+            done, _ = await asyncio.wait(
+                tasks, timeout=delay,
+                return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                del tasks[task]
+                result = task.result()
+                if not _is_error(command, result):
+                    for pending in tasks:
+                        pending.cancel()
+                    return result
+
+            if servers:
+                # Either hedging a slow query or failing over.
+                self._start(tasks, servers.pop(0), command, args, timeout)
+            elif not tasks:
+                # Every server failed, so pass on the last error.
+                return result
+
+    def _start(self, tasks, server, command, args, timeout):
+        task = asyncio.ensure_future(
+            self._request(server, command, args, timeout))
+        tasks[task] = server
+
+    async def _request(self, server, command, args, timeout):
+        method = getattr(server.client, command)
+        server.in_flight += 1
+        start = time.time()
+        try:
+            with tracing.span("client." + command):
+                result = await asyncio.wait_for(method(*args), timeout)
+        except asyncio.TimeoutError:
+            result = _error_result(command, ErrorCode.timeout)
+        except asyncio.CancelledError:
+            # Lost to a hedged query. It took at least this long,
+            # which keeps the server from looking faster than it is.
+            server.add_latency(command, time.time() - start)
+            raise
+        finally:
+            server.in_flight -= 1
+
+        latency = time.time() - start
+        is_error = _is_error(command, result)
+        server.record(command, latency, is_error)
+        metrics.client_query_latency.observe(latency, command)
+        if is_error:
+            ec = result if command == "broadcast" else result[0]
+            metrics.client_query_errors.inc(command,
+                                            getattr(ec, "name", ec))
+        else:
+            self._latencies[command].add(latency)
+        return result
+
+class BlockchainClient:
+
+    # Seconds a successful result stays cached. Transactions never
+    # change. A header at a given height can change in a reorg, so
+    # only headers too deep for that are cached, see _is_deep().
+    _cache_lifetimes = {
+        "transaction": None,
+        "block_header": None
+    }
+
+    # Retries use exponential backoff with full jitter.
+    _backoff_base = 0.2
+    _backoff_max = 10
+
+    # Only headers this deep are kept on disk, safe from reorgs.
+    _stored_header_depth = 100
+
+    def __init__(self, pool, cache_size=10000, retries=3, chain_cache=None):
+        self._pool = pool
+        self._cache_size = cache_size
+        self._retries = retries
+        self._chain_cache = chain_cache
+        self._last_height = None
+
+        # (command, *args): future for queries still in flight.
+        self._pending = {}
+        # (command, *args): (expire_time, result)
+        self._cache = collections.OrderedDict()
+
+    async def last_height(self):
+        ec, height = await self._query("last_height")
+        if not ec:
+            self._last_height = height
+        return ec, height
+
+    async def block_header(self, height):
+        if self._chain_cache is not None:
+            header = self._chain_cache.header(height)
+            if header is not None:
+                return None, header
+
+        ec, header = await self._query("block_header", height)
+        if not ec and self._chain_cache is not None and \
+                self._is_deep(height):
+            self._chain_cache.set_header(height, header)
+        return ec, header
+
+    def _is_deep(self, height):
+        # The tip and the headers near it are always asked for again,
+        # so the reorg check sees a replaced block straight away.
+        return (self._last_height is not None and
+                height <= self._last_height - self._stored_header_depth)
+
+    async def transaction(self, tx_hash):
+        if self._chain_cache is not None:
+            tx_data = self._chain_cache.transaction(tx_hash)
+            if tx_data is not None:
+                return None, tx_data
+
+        ec, tx_data = await self._query("transaction", tx_hash)
+        if not ec and self._chain_cache is not None:
+            self._chain_cache.set_transaction(tx_hash, tx_data)
+        return ec, tx_data
+
+    async def transaction_pool_transaction(self, tx_hash):
+        # Whether the pool has a transaction changes at any time, so
+        # this skips the caches. Older clients lack it, see supports().
+        return await self._retry("transaction_pool_transaction", tx_hash)
+
+    async def history(self, address):
+        return await self._query("history", address)
+
+    def supports(self, command):
+        return self._pool.supports(command)
+
+    async def stealth(self, prefix, from_height):
+        return await self._query("stealth", prefix, from_height)
+
+    async def broadcast(self, tx_data):
+        return await self._retry("broadcast", tx_data)
+
+    async def _query(self, command, *args):
+        key = (command,) + args
+        try:
+            hash(key)
+        except TypeError:
+            return await self._retry(command, *args)
+
+        result = self._cached(key)
+        if result is not None:
+            return result
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._retry(command, *args))
+            self._pending[key] = future
+            future.add_done_callback(
+                lambda future: self._finished(key, future))
+
+        # Several callers may wait on the same query, so one of them
+        # being cancelled must not cancel it for the others.
+        return await asyncio.shield(future)
+
+    async def _retry(self, command, *args):
+        for attempt in range(self._retries + 1):
+            if attempt:
+                delay = min(self._backoff_max,
+                            self._backoff_base * 2 ** attempt)
+                await asyncio.sleep(random.uniform(0, delay))
+            result = await self._pool.query(command, *args)
+            if not _is_error(command, result):
+                break
+        return result
+
+    def _finished(self, key, future):
+        del self._pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        ec, result = future.result()
+        if ec:
+            return
+        self._store(key, (ec, result))
+
+    def _cached(self, key):
+        try:
+            expire_time, result = self._cache[key]
+        except KeyError:
+            return None
+        if expire_time is not None and expire_time < time.time():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return result
+
+    def _store(self, key, result):
+        command = key[0]
+        if command not in self._cache_lifetimes:
+            return
+        if command == "block_header" and not self._is_deep(key[1]):
+            return
+        lifetime = self._cache_lifetimes[command]
+        expire_time = None if lifetime is None else time.time() + lifetime
+
+        self._cache[key] = expire_time, result
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+def connect(context, settings, is_testnet):
+    client_settings = libbitcoin.server.ClientSettings()
+    # We time out queries ourselves, per command.
+    client_settings.query_expire_time = max(
+        timeout_class.maximum for timeout_class
+        in _timeout_classes(settings.query_expire_time).values())
+    client_settings.socks5 = settings.socks5
+
+    servers = []
+    for url in settings.server_urls(is_testnet):
+        # Tornado implementation.
+        if settings.use_tornado_impl:
+            client = FakeAsyncClient(context, url, client_settings)
+        else:
+            client = context.Client(url, client_settings)
+        logger.info("Connected to %s", url)
+        servers.append(ServerConnection(url, client))
+
+    chain_cache = None
+    if settings.chain_cache_size:
+        network = "testnet" if is_testnet else "mainnet"
+        path = os.path.join(settings.config_path, "chain_cache", network)
+        max_size = int(settings.chain_cache_size) * 1024 * 1024
+        chain_cache = ChainCache(path, max_size)
+
+    pool = ClientPool(servers, settings.query_expire_time)
+    return BlockchainClient(pool, settings.query_cache_size,
+                            settings.query_retries, chain_cache)
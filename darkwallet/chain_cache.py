@@ -0,0 +1,193 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+import darkwallet.util
+
+logger = logging.getLogger(__name__)
+
+class ChainCache:
+
+    # Public chain data shared by every account. Entries are appended
+    # to segment files and read back through memory maps. Once over
+    # the size limit the oldest segment is dropped.
+    #
+    # Record layout: crc32, key length, value length, key, value.
+    _record_header = struct.Struct("<IHI")
+    _segment_size = 16 * 1024 * 1024
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        darkwallet.util.make_sure_dir_exists(self._path)
+
+        # key: (segment number, value offset, value length)
+        self._index = {}
+        # segment number: [key, ...]
+        self._segment_keys = {}
+        self._segment_sizes = {}
+        self._maps = {}
+        self._file = None
+
+        self._load()
+
+    # ------------------------------------------------
+    # Chain data.
+    # ------------------------------------------------
+
+    def transaction(self, tx_hash):
+        return self.get(b"t" + tx_hash)
+
+    def set_transaction(self, tx_hash, tx_data):
+        self.put(b"t" + tx_hash, tx_data)
+
+    def header(self, height):
+        return self.get(b"h" + struct.pack("<I", height))
+
+    def set_header(self, height, header_data):
+        self.put(b"h" + struct.pack("<I", height), header_data)
+
+    # ------------------------------------------------
+    # Key value store.
+    # ------------------------------------------------
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key):
+        try:
+            number, offset, length = self._index[key]
+        except KeyError:
+            return None
+        value = bytes(self._map(number, offset + length)[
+            offset:offset + length])
+
+        # Give entries still being used a second chance before
+        # their segment is evicted.
+        if number == self._oldest_segment and number != self._active:
+            self._append(key, value)
+        return value
+
+    def put(self, key, value):
+        if key in self._index:
+            # Content addressed, so the value can't have changed.
+            return
+        self._append(key, value)
+
+    @property
+    def size(self):
+        return sum(self._segment_sizes.values())
+
+    def close(self):
+        for map_ in self._maps.values():
+            map_.close()
+        self._maps.clear()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # ------------------------------------------------
+    # Segments.
+    # ------------------------------------------------
+
+    def _segment_filename(self, number):
+        return os.path.join(self._path, "segment-%08d.dat" % number)
+
+    @property
+    def _oldest_segment(self):
+        return min(self._segment_sizes)
+
+    def _load(self):
+        numbers = sorted(int(filename[8:16]) for filename
+                         in os.listdir(self._path)
+                         if filename.startswith("segment-"))
+        for number in numbers:
+            self._scan(number)
+        self._active = numbers[-1] if numbers else 0
+        self._open_active()
+        self._evict()
+
+    def _scan(self, number):
+        filename = self._segment_filename(number)
+        size = os.path.getsize(filename)
+
+        keys = []
+        offset = 0
+        if size:
+            data = self._map(number, size)
+            while offset + self._record_header.size <= size:
+                checksum, key_length, value_length = \
+                    self._record_header.unpack_from(data, offset)
+                start = offset + self._record_header.size
+                end = start + key_length + value_length
+                if end > size or zlib.crc32(data[start:end]) != checksum:
+                    break
+                key = bytes(data[start:start + key_length])
+                self._index[key] = number, start + key_length, value_length
+                keys.append(key)
+                offset = end
+
+        if offset < size:
+            # Drop a record torn by a crash.
+            logger.warning("Truncating chain cache segment: %s", filename)
+            self._maps.pop(number).close()
+            with open(filename, "r+b") as segment:
+                segment.truncate(offset)
+
+        self._segment_keys[number] = keys
+        self._segment_sizes[number] = offset
+
+    def _open_active(self):
+        self._file = open(self._segment_filename(self._active), "ab")
+        self._segment_keys.setdefault(self._active, [])
+        self._segment_sizes.setdefault(self._active, 0)
+
+    def _append(self, key, value):
+        record_size = self._record_header.size + len(key) + len(value)
+        if self._segment_sizes[self._active] + record_size > \
+                self._segment_size:
+            self._file.close()
+            self._active += 1
+            self._open_active()
+
+        checksum = zlib.crc32(key + value)
+        self._file.write(self._record_header.pack(
+            checksum, len(key), len(value)))
+        self._file.write(key)
+        self._file.write(value)
+        self._file.flush()
+
+        offset = (self._segment_sizes[self._active] +
+                  self._record_header.size + len(key))
+        self._index[key] = self._active, offset, len(value)
+        self._segment_keys[self._active].append(key)
+        self._segment_sizes[self._active] += record_size
+
+        self._evict()
+
+    def _map(self, number, minimum_size):
+        map_ = self._maps.get(number)
+        # The active segment grows, so remap it when needed.
+        if map_ is None or len(map_) < minimum_size:
+            if map_ is not None:
+                map_.close()
+            with open(self._segment_filename(number), "rb") as segment:
+                map_ = mmap.mmap(segment.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            self._maps[number] = map_
+        return map_
+
+    def _evict(self):
+        while self.size > self._max_size and len(self._segment_sizes) > 1:
+            number = self._oldest_segment
+            for key in self._segment_keys.pop(number):
+                # Keys may have been rewritten into a newer segment.
+                if self._index.get(key, (None,))[0] == number:
+                    del self._index[key]
+            del self._segment_sizes[number]
+            map_ = self._maps.pop(number, None)
+            if map_ is not None:
+                map_.close()
+            os.remove(self._segment_filename(number))
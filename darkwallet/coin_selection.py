@@ -0,0 +1,271 @@
+import bisect
+import itertools
+import random
+
+# Serialized sizes in bytes for pay to key hash transactions
+# spending compressed keys.
+TX_OVERHEAD_SIZE = 10
+INPUT_SIZE = 148
+OUTPUT_SIZE = 34
+# Zero value OP_RETURN output carrying the stealth metadata.
+STEALTH_META_OUTPUT_SIZE = 51
+
+# Change smaller than this isn't worth an output.
+DUST_THRESHOLD = 546
+
+def _var_int_size(number):
+    if number < 0xfd:
+        return 1
+    elif number <= 0xffff:
+        return 3
+    return 5
+
+def estimate_size(number_inputs, output_sizes):
+    return (TX_OVERHEAD_SIZE - 2 +
+            _var_int_size(number_inputs) + number_inputs * INPUT_SIZE +
+            _var_int_size(len(output_sizes)) + sum(output_sizes))
+
+class Selection:
+
+    def __init__(self, utxos, amount, fee, change):
+        # [((tx hash, index), value), ...]
+        self.utxos = utxos
+        self.amount = amount
+        self.fee = fee
+        self.change = change
+
+    @property
+    def value(self):
+        return sum(value for point, value in self.utxos)
+
+class UtxoIndex:
+
+    def __init__(self, unspent, is_sorted=False):
+        # Sorted by value, with running totals for range sums.
+        if not is_sorted:
+            unspent = sorted(unspent, key=lambda utxo: utxo[1])
+        self._utxos = unspent
+        self._values = [value for point, value in self._utxos]
+        self._totals = [0] + list(itertools.accumulate(self._values))
+
+    def __len__(self):
+        return len(self._utxos)
+
+    def __getitem__(self, i):
+        return self._utxos[i]
+
+    def value(self, i):
+        return self._values[i]
+
+    def total(self, start, end):
+        return self._totals[end] - self._totals[start]
+
+    def count_below(self, value):
+        # Number of outputs worth value or less.
+        return bisect.bisect_right(self._values, value)
+
+class CoinSelector:
+
+    strategies = ("auto", "branch_and_bound", "knapsack", "largest_first")
+
+    # Bounds on the work done so selection stays fast on big wallets.
+    _max_tries = 500
+    _knapsack_candidates = 100
+    _knapsack_iterations = 20
+
+    def __init__(self, index, fee_rate, strategy="auto"):
+        assert strategy in self.strategies
+        self._index = index
+        self._fee_rate = fee_rate
+        self._strategy = strategy
+
+    @property
+    def _input_fee(self):
+        return self._fee_rate * INPUT_SIZE
+
+    @property
+    def _change_fee(self):
+        return self._fee_rate * OUTPUT_SIZE
+
+    @property
+    def _cost_of_change(self):
+        # Creating the change output now and spending it later.
+        return self._change_fee + self._input_fee
+
+    def select(self, amount, output_sizes, fee=None):
+        # With a fixed fee the selector should be given a zero fee rate.
+        if fee is None:
+            base_fee = self._fee_rate * estimate_size(0, output_sizes)
+        else:
+            base_fee = fee
+        target = amount + base_fee
+
+        # Outputs costing more to spend than they're worth are skipped.
+        self._start = self._index.count_below(self._input_fee)
+
+        # Changeless matches first, then sets paying for a change output.
+        attempts = []
+        if self._strategy in ("auto", "branch_and_bound"):
+            attempts.append((self._branch_and_bound, target, False))
+        if self._strategy in ("auto", "knapsack"):
+            attempts.append((self._knapsack, target + self._change_fee, True))
+        if self._strategy in ("auto", "largest_first"):
+            attempts.append(
+                (self._largest_first, target + self._change_fee, True))
+
+        for strategy, strategy_target, allow_change in attempts:
+            chosen = strategy(strategy_target)
+            if chosen is None:
+                continue
+            selection = self._selection(chosen, amount, output_sizes, fee,
+                                        allow_change)
+            if selection is not None:
+                return selection
+        return None
+
+    def _effective_value(self, i):
+        return self._index.value(i) - self._input_fee
+
+    def _effective_total(self, start, end):
+        return self._index.total(start, end) - (end - start) * self._input_fee
+
+    def _selection(self, chosen, amount, output_sizes, fee, allow_change):
+        utxos = [self._index[i] for i in chosen]
+        value = sum(value for point, value in utxos)
+
+        if fee is None:
+            fee = self._fee_rate * estimate_size(len(utxos), output_sizes)
+        change = value - amount - fee
+        if change < 0:
+            return None
+
+        if allow_change:
+            change_fee = self._change_fee
+            if change - change_fee >= DUST_THRESHOLD:
+                return Selection(utxos, amount, fee + change_fee,
+                                 change - change_fee)
+        # No change output. Whatever is left goes to the fee.
+        return Selection(utxos, amount, fee + change, 0)
+
+    def _branch_and_bound(self, target):
+        # Depth first search for a set of outputs landing between target
+        # and target + cost_of_change, so no change output is needed.
+        # Outputs are tried from the largest down.
+        upper_bound = target + self._cost_of_change
+        end = self._index.count_below(upper_bound + self._input_fee)
+        if end <= self._start:
+            return None
+
+        chosen = []
+        value = 0
+        i = end - 1
+        for _ in range(self._max_tries):
+            backtrack = False
+            if value > upper_bound:
+                backtrack = True
+            elif value >= target:
+                return chosen
+            elif i < self._start:
+                backtrack = True
+            elif value + self._effective_total(self._start, i + 1) < target:
+                # Everything left can't reach the target.
+                backtrack = True
+
+            if backtrack:
+                if not chosen:
+                    return None
+                # Drop the last included output and try without it.
+                i = chosen.pop()
+                value -= self._effective_value(i)
+                i -= 1
+                continue
+
+            chosen.append(i)
+            value += self._effective_value(i)
+            i -= 1
+        return None
+
+    def _knapsack(self, target):
+        # An exact match or the smallest output covering the target
+        # on its own, otherwise the closest random subset of smaller ones.
+        end = self._index.count_below(target + self._input_fee)
+        if end > self._start and self._effective_value(end - 1) == target:
+            return [end - 1]
+
+        smallest_larger = end if end < len(self._index) else None
+
+        # Only the largest of the smaller outputs are considered.
+        start = max(self._start, end - self._knapsack_candidates)
+        if self._effective_total(start, end) < target:
+            if smallest_larger is not None:
+                return [smallest_larger]
+            if start > self._start:
+                # Only reachable with many small outputs.
+                return self._largest_first(target)
+            return None
+
+        candidates = list(range(end - 1, start - 1, -1))
+        best, best_value = self._best_subset(candidates, target)
+        if smallest_larger is not None and \
+                self._effective_value(smallest_larger) <= best_value:
+            return [smallest_larger]
+        return best
+
+    def _best_subset(self, candidates, target):
+        best = candidates
+        best_value = sum(self._effective_value(i) for i in candidates)
+        for _ in range(self._knapsack_iterations):
+            chosen = []
+            value = 0
+            for i in candidates:
+                if random.random() < 0.5:
+                    continue
+                chosen.append(i)
+                value += self._effective_value(i)
+                if value >= target:
+                    break
+            if target <= value < best_value:
+                best, best_value = chosen, value
+                if value == target:
+                    break
+        # Trim to the outputs actually needed, largest first.
+        trimmed = []
+        value = 0
+        for i in sorted(best, reverse=True):
+            trimmed.append(i)
+            value += self._effective_value(i)
+            if value >= target:
+                break
+        return trimmed, value
+
+    def _largest_first(self, target):
+        chosen = []
+        value = 0
+        for i in range(len(self._index) - 1, self._start - 1, -1):
+            chosen.append(i)
+            value += self._effective_value(i)
+            if value >= target:
+                return chosen
+        return None
+
+def select_consolidation(index, fee_rate, maximum_value, max_inputs):
+    # Sweep the smallest outputs worth more than they cost to spend
+    # into a single change output.
+    input_fee = fee_rate * INPUT_SIZE
+    start = index.count_below(input_fee)
+    end = min(index.count_below(maximum_value), start + max_inputs)
+    if end - start < 2:
+        return None
+
+    utxos = [index[i] for i in range(start, end)]
+    value = index.total(start, end)
+    fee = fee_rate * estimate_size(len(utxos), [OUTPUT_SIZE])
+    change = value - fee
+    if change < DUST_THRESHOLD:
+        return None
+    return Selection(utxos, 0, fee, change)
+
+def output_size(is_stealth):
+    if is_stealth:
+        return OUTPUT_SIZE + STEALTH_META_OUTPUT_SIZE
+    return OUTPUT_SIZE
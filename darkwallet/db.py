@@ -1,9 +1,38 @@
+import contextvars
 import datetime
+import time
 from enum import Enum
 from playhouse.sqlcipher_ext import *
 from darkwallet.db_fields import *
+import darkwallet.metrics as metrics
+import darkwallet.tracing as tracing
 
-db = SqlCipherDatabase(None)
+_active_database = contextvars.ContextVar("active_database", default=None)
+
+class AccountDatabase(Proxy):
+
+    # Every open account has its own SQLCipher database. The models
+    # resolve the database per asyncio task, so several accounts (and
+    # their background processes) can be open at the same time.
+
+    @property
+    def obj(self):
+        return _active_database.get()
+
+    @obj.setter
+    def obj(self, database):
+        _active_database.set(database)
+
+    def execute_sql(self, *args, **kwargs):
+        start = time.time()
+        try:
+            with tracing.span("db"):
+                return self.obj.execute_sql(*args, **kwargs)
+        finally:
+            metrics.db_queries.inc()
+            metrics.db_query_time.observe(time.time() - start)
+
+db = AccountDatabase()
 
 class Error(Enum):
     short_password = 0
@@ -79,13 +108,19 @@ class History(BaseModel):
     index_ = IntegerField()
     height = IntegerField()
 
-    value = BitcoinValueField()
+    value = SatoshiField()
 
 class SentPayments(BaseModel):
     tx_hash = HashDigestField(unique=True)
     tx = TransactionField()
     replaced_by = ForeignKeyField("self", null=True, default=None)
-    is_confirmed = BooleanField(default=False)
+    is_confirmed = BooleanField(default=False, index=True)
+    confirmed_height = IntegerField(null=True, default=None)
+    # Rebroadcasting backs off separately for each payment. A null
+    # next_broadcast is due straight away.
+    broadcast_attempts = IntegerField(default=0)
+    last_broadcast = DateTimeField(null=True, default=None)
+    next_broadcast = DateTimeField(null=True, default=None)
     created_date = DateTimeField(default=datetime.datetime.now)
 
     account = ForeignKeyField(Account, related_name="sent_payments")
@@ -94,10 +129,36 @@ class SentPayments(BaseModel):
 class SentPaymentDestinations(BaseModel):
     parent = ForeignKeyField(SentPayments, related_name="destinations")
     address = CharField(index=True)
-    value = BitcoinValueField()
+    value = SatoshiField()
+
+class PocketBalance(BaseModel):
+    # Running totals in satoshis, kept in step with History.
+    pocket = ForeignKeyField(Pocket, unique=True, related_name="balance")
+    confirmed = BigIntegerField(default=0)
+    unconfirmed = BigIntegerField(default=0)
+
+class QueuedPayouts(BaseModel):
+    account = ForeignKeyField(Account, related_name="queued_payouts")
+    pocket = ForeignKeyField(Pocket, null=True, related_name="queued_payouts")
+    address = CharField()
+    value = BigIntegerField()
+    created_date = DateTimeField(default=datetime.datetime.now)
+
+# SQLite limits the number of parameters in one statement.
+_max_parameters = 500
+
+def chunks(values):
+    values = list(values)
+    for i in range(0, len(values), _max_parameters):
+        yield values[i:i + _max_parameters]
 
 def initialize(filename, passphrase):
-    db.init(filename, passphrase=passphrase)
+    database = SqlCipherDatabase(filename, passphrase=passphrase)
+    activate(database)
+    return database
+
+def activate(database):
+    db.initialize(database)
 
 def create_tables():
     db.create_tables([
@@ -109,6 +170,96 @@ def create_tables():
         TransactionCache,
         History,
         SentPayments,
-        SentPaymentDestinations
+        SentPaymentDestinations,
+        QueuedPayouts,
+        PocketBalance
     ])
+    _set_schema_version(len(_migrations))
+
+# ------------------------------------------------
+# Upgrade accounts created with an older schema.
+# ------------------------------------------------
+
+def _schema_version():
+    return db.execute_sql("PRAGMA user_version").fetchone()[0]
+
+def _set_schema_version(version):
+    db.execute_sql("PRAGMA user_version = %d" % version)
+
+def _add_queued_payouts():
+    db.create_tables([QueuedPayouts], safe=True)
+
+def _add_pocket_balances():
+    db.create_tables([PocketBalance], safe=True)
+    # Unconfirmed history has a height of 0.
+    db.execute_sql("""
+        INSERT INTO pocketbalance (pocket_id, confirmed, unconfirmed)
+        SELECT pocket.id,
+            COALESCE((SELECT CAST(ROUND(SUM(value) * 100000000) AS INTEGER)
+                FROM history WHERE history.pocket_id = pocket.id
+                AND history.height != 0), 0),
+            COALESCE((SELECT CAST(ROUND(SUM(value) * 100000000) AS INTEGER)
+                FROM history WHERE history.pocket_id = pocket.id
+                AND history.height = 0), 0)
+        FROM pocket""")
+
+def _convert_to_satoshis(model):
+    # SQLite can't change a column's type, so rebuild the table.
+    table = model._meta.db_table
+    old_table = table + "_old"
+    db.execute_sql("ALTER TABLE %s RENAME TO %s" % (table, old_table))
+    # The indexes keep their names, which the new table needs.
+    indexes = db.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = ? AND sql IS NOT NULL", (old_table,)).fetchall()
+    for name, in indexes:
+        db.execute_sql('DROP INDEX "%s"' % name)
+    db.create_tables([model])
+
+    columns = [field.db_column for field in model._meta.sorted_fields]
+    values = ["CAST(ROUND(value * 100000000) AS INTEGER)"
+              if column == "value" else column for column in columns]
+    db.execute_sql("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+        table, ", ".join(columns), ", ".join(values), old_table))
+    db.execute_sql("DROP TABLE %s" % old_table)
+
+def _store_satoshis():
+    _convert_to_satoshis(History)
+    _convert_to_satoshis(SentPaymentDestinations)
+
+def _add_confirmed_height():
+    db.execute_sql("ALTER TABLE sentpayments "
+                   "ADD COLUMN confirmed_height INTEGER")
+    db.execute_sql('CREATE INDEX "sentpayments_is_confirmed" '
+                   'ON "sentpayments" ("is_confirmed")')
+    db.execute_sql("""
+        UPDATE sentpayments SET confirmed_height = (
+            SELECT MIN(height) FROM history
+            WHERE history.hash = sentpayments.tx_hash
+            AND history.height != 0)
+        WHERE is_confirmed""")
+
+def _add_rebroadcast_schedule():
+    db.execute_sql("ALTER TABLE sentpayments "
+                   "ADD COLUMN broadcast_attempts INTEGER NOT NULL DEFAULT 0")
+    db.execute_sql("ALTER TABLE sentpayments "
+                   "ADD COLUMN last_broadcast DATETIME")
+    db.execute_sql("ALTER TABLE sentpayments "
+                   "ADD COLUMN next_broadcast DATETIME")
+
+# Applied in order. Only ever append to this list.
+_migrations = [
+    _add_queued_payouts,
+    _add_pocket_balances,
+    _store_satoshis,
+    _add_confirmed_height,
+    _add_rebroadcast_schedule
+]
+
+def migrate():
+    start = _schema_version()
+    for version, migration in enumerate(_migrations[start:], start):
+        with db.atomic():
+            migration()
+            _set_schema_version(version + 1)
 
@@ -89,10 +89,8 @@ class EcSecretField(Field):
     def python_value(self, secret):
         return bc.EcSecret.from_string(secret)
 
-class BitcoinValueField(DecimalField):
+class SatoshiField(BigIntegerField):
     def __init__(self):
-        super().__init__(max_digits=16, decimal_places=8,
-                         constraints=[Check(
-                             "value < 20999999.9769 and "
-                             "value > -20999999.9769")])
-
+        super().__init__(constraints=[Check(
+            "value <= 2100000000000000 and "
+            "value >= -2100000000000000")])
@@ -1,5 +1,6 @@
 import asyncio
 import json
+import logging
 import random
 import signal
 import tornado.options
@@ -7,11 +8,11 @@ import tornado.web
 import tornado.websocket
 
 from libbitcoin.server_fake_async import TornadoContext
+import darkwallet.metrics as metrics
+import darkwallet.tracing as tracing
 from darkwallet.wallet_interface import WalletInterface
 
-# Debug stuff
-#import logging
-#logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 class QuerySocketHandler(tornado.websocket.WebSocketHandler):
 
@@ -35,16 +36,28 @@ class QuerySocketHandler(tornado.websocket.WebSocketHandler):
         try:
             request = json.loads(message)
         except:
-            logging.error("Error decoding message: %s", message, exc_info=True)
+            logger.error("Error decoding message.", exc_info=True)
             self.close()
             return
 
         # Check request is correctly formed.
         if not self._check_request(request):
-            logging.error("Malformed request: %s", request, exc_info=True)
+            # Requests can hold passwords, so they aren't logged.
+            logger.error("Malformed request.")
             self.close()
             return
 
+        if (request["command"] in self._wallet.commands and
+                self._wallet.is_streaming(request)):
+            responses = self._wallet.stream(request)
+            async for response in responses:
+                # The next chunk is only made once this one is written,
+                # so a slow client doesn't pile the stream up in memory.
+                if not await self._send_and_wait(response):
+                    await responses.aclose()
+                    break
+            return
+
         response = await self._handle_request(request)
         if response is None:
             self.close()
@@ -53,12 +66,12 @@ class QuerySocketHandler(tornado.websocket.WebSocketHandler):
         self.queue(response)
 
     async def _handle_request(self, request):
-        print("Request", request)
+        logger.debug("Request %s: %s", request["id"], request["command"])
         if request["command"] in self._wallet.commands:
             response = await self._wallet.handle(request)
         else:
-            logging.warning("Unhandled command. Dropping request: %s",
-                request, exc_info=True)
+            logger.warning("Unhandled command. Dropping request: %s",
+                           request["command"])
             return None
         return response
 
@@ -66,17 +79,39 @@ class QuerySocketHandler(tornado.websocket.WebSocketHandler):
         # Calling write_message on the socket is not thread safe
         self._context.spawn(self._send, message)
 
-    def _send(self, message):
-        print("Response", message)
+    async def _send_and_wait(self, message):
+        # Returns False if the socket closed before it was written.
+        loop = asyncio.get_event_loop()
+        written = loop.create_future()
+        def on_written(is_written):
+            loop.call_soon_threadsafe(
+                lambda: written.done() or written.set_result(is_written))
+        self._context.spawn(self._send, message, on_written)
+        return await written
+
+    def _send(self, message, on_written=None):
+        logger.debug("Response %s", message["id"])
         try:
-            self.write_message(message)
+            write_future = self.write_message(message)
         except tornado.websocket.WebSocketClosedError:
-            logging.warning("Dropping response to closed socket: %s",
-                            message, exc_info=True)
-        except Exception as e:
-            print("Error sending:", str(e))
-            print("Message:", message.keys())
+            logger.warning("Dropping response %s to closed socket.",
+                           message["id"])
+            if on_written is not None:
+                on_written(False)
+            return
+        except Exception:
+            logger.exception("Error sending response %s.", message["id"])
+            if on_written is not None:
+                on_written(False)
             raise
+        if on_written is None:
+            return
+        # Tornado resolves the future once the message is flushed.
+        if write_future is None:
+            on_written(True)
+        else:
+            write_future.add_done_callback(
+                lambda future: on_written(future.exception() is None))
 
 class GatewayApplication(tornado.web.Application):
 
@@ -96,20 +131,26 @@ class GatewayApplication(tornado.web.Application):
         super().__init__(handlers, tornado_settings)
 
     def start_listen(self):
-        print("Listening on port %s" % self._settings.port)
+        logger.info("Listening on port %s", self._settings.port)
         self.listen(self._settings.port)
 
 def start(settings):
     context = TornadoContext()
+    metrics_server = None
     # Handle CTRL-C
     def signal_handler():
-        print("Stopping darkwallet-daemon...")
+        logger.info("Stopping darkwallet-daemon...")
+        if metrics_server is not None:
+            metrics_server.stop()
         context.stop()
     loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGINT, signal_handler)
+    loop.add_signal_handler(signal.SIGUSR1, lambda: tracing.tracer.enable(
+        tracing.directory(settings), settings.trace_count))
     # Create main application
     app = GatewayApplication(context, settings)
     app.start_listen()
+    metrics_server = metrics.start_server(settings)
     # Run loop
     context.start()
 
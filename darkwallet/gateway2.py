@@ -1,7 +1,7 @@
 import asyncio
 import json
+import logging
 import signal
-import sys
 import websockets
 
 import zmq.asyncio
@@ -10,51 +10,71 @@ asyncio.set_event_loop(loop)
 
 import libbitcoin.server
 
+import darkwallet.metrics as metrics
+import darkwallet.tracing as tracing
 from darkwallet.wallet_interface import WalletInterface
 
+logger = logging.getLogger(__name__)
+
 class Gateway:
 
-    def __init__(self, settings):
+    def __init__(self, settings, context=None):
         self.settings = settings
 
-        self.context = libbitcoin.server.Context()
+        if context is None:
+            context = libbitcoin.server.Context()
+        self.context = context
         self._wallet = WalletInterface(self.context, settings)
+        self._metrics_server = None
 
     def stop(self):
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
         self.context.stop()
         self._wallet.stop()
 
     async def _accept(self, websocket, path):
-        print("Connection opened.")
+        logger.debug("Connection opened.")
         try:
             while True:
                 await self._process(websocket, path)
         except websockets.ConnectionClosed:
-            print("Closing connection.")
+            logger.debug("Closing connection.")
 
     async def _process(self, websocket, path):
         message = await websocket.recv()
         try:
             request = json.loads(message)
         except json.JSONDecodeError:
-            print("Error: decoding request", file=sys.stderr)
+            logger.error("Decoding request.")
             return
 
         # Check request is correctly formed.
         if not self._check(request):
-            print("Error: malformed request:", message, file=sys.stderr)
+            # Requests can hold passwords, so they aren't logged.
+            logger.error("Malformed request.")
             return
 
         if self._is_stop_command(request):
-            print("Stopping darkwallet-daemon...")
+            logger.info("Stopping darkwallet-daemon...")
             self.stop()
             loop.stop()
             return
         elif request["command"] in self._wallet.commands:
+            if self._wallet.is_streaming(request):
+                responses = self._wallet.stream(request)
+                try:
+                    async for response in responses:
+                        await websocket.send(json.dumps(response))
+                finally:
+                    # Ends the request straight away if the client
+                    # goes, rather than whenever it's collected.
+                    await responses.aclose()
+                return
             response = await self._wallet.handle(request)
         else:
-            print("Error: unhandled command. Dropping:",
-                  message, file=sys.stderr)
+            logger.warning("Unhandled command. Dropping request: %s",
+                           request["command"])
             return
 
         message = json.dumps(response)
@@ -81,6 +101,7 @@ class Gateway:
 
     async def serve(self):
         port = self.settings.port
+        self._metrics_server = metrics.start_server(self.settings)
         return await websockets.serve(self._accept, "localhost", port)
 
 def start_ws(settings):
@@ -90,11 +111,13 @@ def start_ws(settings):
 
     # Handle CTRL-C
     def signal_handler():
-        print("Stopping darkwallet-daemon...")
+        logger.info("Stopping darkwallet-daemon...")
         gateway.stop()
         loop.stop()
 
     loop.add_signal_handler(signal.SIGINT, signal_handler)
+    loop.add_signal_handler(signal.SIGUSR1, lambda: tracing.tracer.enable(
+        tracing.directory(settings), settings.trace_count))
     loop.run_until_complete(asyncio.wait(tasks))
     loop.run_forever()
 
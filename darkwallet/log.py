@@ -0,0 +1,109 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Every module logs through logging.getLogger(__name__), which puts it
+# under the "darkwallet" logger configured here.
+
+_format = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+class RateLimitFilter(logging.Filter):
+
+    # Lets through at most limit records from the same call site (the
+    # unformatted message) each interval. The next record let through
+    # says how many were dropped.
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self._limit = limit
+        self._interval = interval
+        # (logger, level, message): [window start, count, suppressed]
+        self._windows = {}
+
+    def filter(self, record):
+        if not self._limit:
+            return True
+        # Every handler shares this filter. Decide once per record.
+        if not hasattr(record, "rate_limited"):
+            record.rate_limited = not self._allow(record)
+        return not record.rate_limited
+
+    def _allow(self, record):
+        key = record.name, record.levelno, record.msg
+        window = self._windows.get(key)
+        if window is None or record.created - window[0] >= self._interval:
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [record.created, 1, 0]
+            if suppressed:
+                record.msg = "%s (%s similar messages suppressed)" % (
+                    record.getMessage(), suppressed)
+                record.args = None
+            return True
+        if window[1] < self._limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    # The default prepare() formats the whole record in the calling
+    # thread. Only merge the arguments so the listener thread does
+    # the formatting.
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+def _json_handler(filename):
+    # Written to the file by a background thread.
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return _QueueHandler(log_queue)
+
+def setup(settings):
+    logger = logging.getLogger("darkwallet")
+    logger.setLevel(settings.log_level.upper())
+    logger.propagate = False
+
+    handlers = [logging.StreamHandler(sys.stderr)]
+    handlers[0].setFormatter(logging.Formatter(_format))
+    if settings.log_file:
+        handlers.append(_json_handler(settings.log_file))
+
+    rate_limit = RateLimitFilter(settings.log_rate_limit,
+                                 settings.log_rate_interval)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    for handler in handlers:
+        handler.addFilter(rate_limit)
+        logger.addHandler(handler)
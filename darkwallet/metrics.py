@@ -0,0 +1,209 @@
+import asyncio
+import bisect
+import collections
+import logging
+
+# Metrics in the Prometheus text format, served over HTTP on the
+# metrics port (GET /metrics).
+
+logger = logging.getLogger(__name__)
+
+_default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+
+    type_name = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        # label values: value
+        self._values = collections.OrderedDict()
+
+    def _key(self, label_values):
+        assert len(label_values) == len(self.labels)
+        return tuple(str(value) for value in label_values)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s %s" % (self.name, self.type_name)]
+        for key, value in self._values.items():
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.labels, key),
+                             _format_number(value))]
+
+class Counter(Metric):
+
+    type_name = "counter"
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    type_name = "gauge"
+
+    def set(self, value, *label_values):
+        self._values[self._key(label_values)] = value
+
+class Histogram(Metric):
+
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=_default_buckets):
+        super().__init__(name, help_text, labels)
+        self._buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        entry = self._values.get(key)
+        if entry is None:
+            # Bucket counts, sum, count
+            entry = self._values[key] = [[0] * len(self._buckets), 0, 0]
+        entry[0][bisect.bisect_left(self._buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labels, key,
+                                    [("le", _format_number(bound))])
+            lines.append("%s_bucket%s %s" % (self.name, labels, cumulative))
+        labels = _format_labels(self.labels, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, repr(total)))
+        lines.append("%s_count%s %s" % (self.name, labels, count))
+        return lines
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=_default_buckets):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+rpc_requests = registry.counter(
+    "darkwallet_rpc_requests_total", "RPC requests handled.",
+    ("command", "error"))
+rpc_latency = registry.histogram(
+    "darkwallet_rpc_latency_seconds", "Time taken to answer RPC requests.",
+    ("command",))
+process_update = registry.histogram(
+    "darkwallet_process_update_seconds",
+    "Time taken by each background process update.", ("process",))
+client_query_latency = registry.histogram(
+    "darkwallet_client_query_seconds",
+    "Blockchain server query latency.", ("command",))
+client_query_errors = registry.counter(
+    "darkwallet_client_query_errors_total",
+    "Blockchain server queries that failed.", ("command", "error"))
+db_queries = registry.counter(
+    "darkwallet_db_queries_total", "SQL statements executed.")
+db_query_time = registry.histogram(
+    "darkwallet_db_query_seconds", "Time taken by SQL statements.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+rebroadcasts = registry.counter(
+    "darkwallet_rebroadcasts_total",
+    "Pending payments checked for rebroadcasting, by outcome.",
+    ("result",))
+rebroadcast_attempts = registry.histogram(
+    "darkwallet_rebroadcast_attempts",
+    "Times each payment had been broadcast when it was sent again.",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+sync_lag = registry.gauge(
+    "darkwallet_sync_lag_blocks",
+    "Blocks the least recently scanned address is behind.", ("account",))
+
+class MetricsServer:
+
+    def __init__(self, port, host="127.0.0.1"):
+        self._port = port
+        self._host = host
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self._host, self._port)
+        logger.info("Serving metrics on port %s", self._port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers.
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and \
+                    parts[1].split("?")[0] == "/metrics":
+                self._respond(writer, "200 OK", registry.render())
+            else:
+                self._respond(writer, "404 Not Found", "Not found.\n")
+            await writer.drain()
+        except ConnectionError as error:
+            logger.warning("Serving metrics: %s", error)
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, body):
+        body = body.encode()
+        writer.write(("HTTP/1.1 %s\r\n"
+                      "Content-Type: text/plain; version=0.0.4\r\n"
+                      "Content-Length: %s\r\n"
+                      "Connection: close\r\n\r\n" % (status, len(body)))
+                     .encode())
+        writer.write(body)
+
+def start_server(settings):
+    # A port of 0 turns the metrics off.
+    if not settings.metrics_port:
+        return None
+    server = MetricsServer(settings.metrics_port)
+    asyncio.ensure_future(server.start())
+    return server
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+
+from libbitcoin import bc
+import darkwallet.db as db
+
+logger = logging.getLogger(__name__)
+
+class RestorePipeline:
+
+    # Rebuilds a restored account's history before live syncing
+    # starts. Keys are derived in large batches, their histories
+    # fetched concurrently and written in bulk. Each pocket keeps
+    # deriving until gap_limit keys past its last used one are unused.
+    # Then every transaction is fetched into the cache the same way.
+
+    def __init__(self, client, model, settings):
+        self._client = client
+        self._model = model
+        self._gap_limit = settings.gap_limit
+        self._batch_size = max(settings.restore_batch_size,
+                               settings.gap_limit)
+        self._concurrency = settings.restore_concurrency
+        self._semaphore = None
+        self._height = None
+
+        self.stage = "starting"
+        self.addresses = 0
+        self.scanned = 0
+        self.used = 0
+        self.transactions = 0
+        self.fetched = 0
+        self.errors = 0
+        self._start_time = time.time()
+        self._end_time = None
+
+    @property
+    def is_finished(self):
+        return self.stage in ("done", "failed")
+
+    @property
+    def status(self):
+        end_time = self._end_time or time.time()
+        return {
+            "stage": self.stage,
+            "addresses": self.addresses,
+            "scanned": self.scanned,
+            "used": self.used,
+            "transactions": self.transactions,
+            "fetched": self.fetched,
+            "errors": self.errors,
+            "seconds": end_time - self._start_time
+        }
+
+    async def run(self):
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        try:
+            if await self._record_head():
+                self.stage = "scanning"
+                for pocket in self._model.pockets:
+                    await self._discover(pocket)
+                self.stage = "caching"
+                await self._fill_cache()
+                self.stage = "done"
+            else:
+                self.stage = "failed"
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Restore failed.")
+            self.stage = "failed"
+        self._end_time = time.time()
+        logger.info("Restore %s. %s", self.stage, self.status)
+
+    async def _record_head(self):
+        ec, height = await self._client.last_height()
+        if ec:
+            logger.error("Querying last_height: %s", ec)
+            return False
+        ec, header = await self._client.block_header(height)
+        if ec:
+            logger.error("Querying header: %s", ec)
+            return False
+        header = bc.Header.from_data(header)
+        # Live syncing carries on from here.
+        self._model.current_index = height, header.hash()
+        self._height = height
+        return True
+
+    async def _discover(self, pocket):
+        tracker = self._model.cache.track_address_updates
+        addresses = [address for address in pocket.addrs_normal
+                     if tracker.last_updated_height(address) != self._height]
+        self.addresses += pocket.number_normal_keys()
+        while True:
+            await self._scan(addresses, pocket)
+
+            needed = pocket.max_used_index() + 1 + self._gap_limit
+            number_keys = pocket.number_normal_keys()
+            if number_keys >= needed:
+                return
+            # Derive well past the gap so the queries stay busy.
+            addresses = pocket.add_keys(
+                max(needed - number_keys, self._batch_size))
+            self.addresses += len(addresses)
+
+    async def _scan(self, addresses, pocket):
+        results = await asyncio.gather(*[
+            self._history(address) for address in addresses])
+        entries = [(address, history, pocket) for address, history
+                   in zip(addresses, results) if history is not None]
+
+        # Addresses which failed are left for live syncing.
+        tracker = self._model.cache.track_address_updates
+        with db.db.atomic():
+            self._model.cache.history.set_many(entries)
+            for address, _, _ in entries:
+                tracker.set_last_updated_height(address, self._height)
+
+    async def _history(self, address):
+        async with self._semaphore:
+            ec, history = await self._client.history(address.encoded())
+        self.scanned += 1
+        if ec:
+            logger.warning("Couldn't fetch history: %s", ec)
+            self.errors += 1
+            return None
+        if history:
+            self.used += 1
+        return history
+
+    async def _fill_cache(self):
+        cache = self._model.cache
+        # History lists a transaction once per output and spend.
+        tx_hashes = {bc.encode_hash(tx_hash): tx_hash
+                     for tx_hash in cache.history.transaction_hashes}
+        for encoded_hash in cache.transactions.many(list(tx_hashes)):
+            del tx_hashes[encoded_hash]
+        tx_hashes = list(tx_hashes.values())
+        self.transactions = len(tx_hashes)
+
+        for i in range(0, len(tx_hashes), self._batch_size):
+            batch = tx_hashes[i:i + self._batch_size]
+            results = await asyncio.gather(*[
+                self._transaction(tx_hash) for tx_hash in batch])
+            cache.transactions.set_many([
+                (tx_hash, tx) for tx_hash, tx in zip(batch, results)
+                if tx is not None])
+
+    async def _transaction(self, tx_hash):
+        async with self._semaphore:
+            ec, tx_data = await self._client.transaction(tx_hash.data)
+        if ec:
+            logger.warning("Couldn't fetch transaction: %s", ec)
+            self.errors += 1
+            return None
+        self.fetched += 1
+        return bc.Transaction.from_data(tx_data)
@@ -1,19 +1,23 @@
 import argparse
 import configparser
+import logging
 import os.path
 
+from darkwallet.coin_selection import CoinSelector
 import darkwallet.util
 
+logger = logging.getLogger(__name__)
+
 def get_default_config_path():
     return os.path.join(os.path.expanduser("~"), ".darkwallet")
 
 class Settings:
 
-    def load(self):
-        args = self._parse()
+    def load(self, argv=None):
+        args = self._parse(argv)
         self._load(args)
 
-    def _parse(self):
+    def _parse(self, argv):
         # Command line arguments
         parser = argparse.ArgumentParser(prog="darkwallet-daemon")
         parser.add_argument("--version", "-v", action="version",
@@ -24,10 +28,13 @@ class Settings:
         parser.add_argument("--port", "-p", dest="port",
                             help="Run on the given port.",
                             default=None)
+        parser.add_argument("--log-level", "-l", dest="log_level",
+                            choices=["debug", "info", "warning", "error"],
+                            help="Change the log level.", default=None)
         parser.add_argument("--tornado", "-t", dest="use_tornado",
                             action="store_const", const=True, default=False,
                             help="Use the Tornado implementation instead.")
-        return parser.parse_args()
+        return parser.parse_args(argv)
 
     def _load(self, args):
         self.use_tornado_impl = args.use_tornado
@@ -35,7 +42,9 @@ class Settings:
         self.config_path = args.config
         darkwallet.util.make_sure_dir_exists(self.config_path)
         self.config_filename = os.path.join(self.config_path, "darkwallet.cfg")
-        darkwallet.util.make_sure_file_exists(self.config_filename)
+        # Logging isn't set up yet, so the daemon reports this later.
+        self.is_new_config = darkwallet.util.make_sure_file_exists(
+            self.config_filename)
 
         config = configparser.ConfigParser()
         config.read(self.config_filename)
@@ -46,11 +55,77 @@ class Settings:
         self.port = args.port
         if self.port is None:
             self.port = int(main.get("port", 8888))
+        # Prometheus metrics on localhost. 0 turns them off.
+        self.metrics_port = int(main.get("metrics-port", 9888))
 
         # [wallet]
         wallet = config["wallet"]
         self.gap_limit = int(wallet.get("gap-limit", 5))
         self.master_pocket_name = wallet.get("master-pocket-name", "master")
+        self.max_open_accounts = max(
+            int(wallet.get("max-open-accounts", 1)), 1)
+        # Satoshis per byte paid when no fee is given for a send.
+        self.fee_rate = int(wallet.get("fee-rate", 20))
+        self.coin_selection = wallet.get("coin-selection", "auto")
+        if self.coin_selection not in CoinSelector.strategies:
+            logger.warning("Unknown coin-selection %s. Using auto.",
+                           self.coin_selection)
+            self.coin_selection = "auto"
+        self.signing_threads = max(int(wallet.get("signing-threads", 4)), 1)
+        # Queued payouts go out together once enough of them are
+        # waiting or the oldest has waited long enough (seconds).
+        self.payout_batch_size = max(
+            int(wallet.get("payout-batch-size", 100)), 1)
+        self.payout_batch_age = int(wallet.get("payout-batch-age", 300))
+        # Outputs below this value (satoshis) get consolidated.
+        self.consolidate_below = int(wallet.get("consolidate-below", 100000))
+        # Fee rate for consolidating. 0 disables automatic consolidation.
+        self.consolidate_fee_rate = int(
+            wallet.get("consolidate-fee-rate", 0))
+        # Seconds between automatic consolidations.
+        self.consolidate_interval = int(
+            wallet.get("consolidate-interval", 600))
+        self.consolidate_min_inputs = int(
+            wallet.get("consolidate-min-inputs", 20))
+        self.consolidate_max_inputs = int(
+            wallet.get("consolidate-max-inputs", 200))
+        # Restoring derives keys this many at a time and keeps up to
+        # restore-concurrency server queries in flight.
+        self.restore_batch_size = max(
+            int(wallet.get("restore-batch-size", 500)), 1)
+        self.restore_concurrency = max(
+            int(wallet.get("restore-concurrency", 32)), 1)
+        # What each background process may spend per tick before
+        # leaving the rest of its work for the next one.
+        self.process_time_budget = float(
+            wallet.get("process-time-budget", 2.0))
+        self.process_query_budget = max(
+            int(wallet.get("process-query-budget", 500)), 1)
+        # Seconds before an unconfirmed payment is first sent again.
+        # The wait doubles after every broadcast up to the maximum.
+        self.rebroadcast_interval = max(
+            float(wallet.get("rebroadcast-interval", 1200)), 1)
+        self.rebroadcast_max_interval = max(
+            float(wallet.get("rebroadcast-max-interval", 86400)),
+            self.rebroadcast_interval)
+        self.rebroadcast_concurrency = max(
+            int(wallet.get("rebroadcast-concurrency", 8)), 1)
+
+        # [logging] is missing from older config files.
+        log = config["logging"] if config.has_section("logging") else {}
+        # save() writes back the config file values, not the overrides.
+        self._config_log_level = log.get("level", "info")
+        self.log_level = args.log_level or self._config_log_level
+        # Optional file of JSON log lines, relative to the config path.
+        self._config_log_file = log.get("json-file", "")
+        self.log_file = self._config_log_file
+        if self.log_file:
+            self.log_file = os.path.join(self.config_path, self.log_file)
+        # Repeats of the same message allowed per interval (seconds).
+        self.log_rate_limit = int(log.get("rate-limit", 10))
+        self.log_rate_interval = float(log.get("rate-interval", 60))
+        # Requests and process cycles traced after a SIGUSR1.
+        self.trace_count = int(log.get("trace-count", 10))
 
         # [bs]
         bs = config["blockchain-server"]
@@ -59,20 +134,58 @@ class Settings:
             "tcp://testnet.unsystem.net:9091")
         self.query_expire_time = float(bs.get("query-expire-time", 4.0))
         self.socks5 = bs.get("socks5", None)
+        self.query_cache_size = int(bs.get("query-cache-size", 10000))
+        self.query_retries = int(bs.get("query-retries", 3))
+        # Megabytes on disk, or 0 to disable the shared chain cache.
+        self.chain_cache_size = int(bs.get("chain-cache-size", 256))
+
+    def server_urls(self, is_testnet):
+        # Several servers can be given separated by commas.
+        urls = self.testnet_url if is_testnet else self.url
+        return [url.strip() for url in urls.split(",") if url.strip()]
 
     def save(self):
         config = configparser.ConfigParser()
         config["main"] = {
-            "port": self.port
+            "port": self.port,
+            "metrics-port": self.metrics_port
         }
         config["wallet"] = {
             "gap-limit": self.gap_limit,
-            "master-pocket-name": self.master_pocket_name
+            "master-pocket-name": self.master_pocket_name,
+            "max-open-accounts": self.max_open_accounts,
+            "fee-rate": self.fee_rate,
+            "coin-selection": self.coin_selection,
+            "signing-threads": self.signing_threads,
+            "payout-batch-size": self.payout_batch_size,
+            "payout-batch-age": self.payout_batch_age,
+            "consolidate-below": self.consolidate_below,
+            "consolidate-fee-rate": self.consolidate_fee_rate,
+            "consolidate-interval": self.consolidate_interval,
+            "consolidate-min-inputs": self.consolidate_min_inputs,
+            "consolidate-max-inputs": self.consolidate_max_inputs,
+            "restore-batch-size": self.restore_batch_size,
+            "restore-concurrency": self.restore_concurrency,
+            "process-time-budget": self.process_time_budget,
+            "process-query-budget": self.process_query_budget,
+            "rebroadcast-interval": self.rebroadcast_interval,
+            "rebroadcast-max-interval": self.rebroadcast_max_interval,
+            "rebroadcast-concurrency": self.rebroadcast_concurrency
+        }
+        config["logging"] = {
+            "level": self._config_log_level,
+            "json-file": self._config_log_file,
+            "rate-limit": self.log_rate_limit,
+            "rate-interval": self.log_rate_interval,
+            "trace-count": self.trace_count
         }
         config["blockchain-server"] = {
             "url": self.url,
             "testnet-url": self.testnet_url,
-            "query-expire-time": self.query_expire_time
+            "query-expire-time": self.query_expire_time,
+            "query-cache-size": self.query_cache_size,
+            "query-retries": self.query_retries,
+            "chain-cache-size": self.chain_cache_size
         }
         if self.socks5:
             config["blockchain-server"]["socks5"] = self.socks5
@@ -1,5 +1,8 @@
+import logging
+
 from darkwallet.sodium.config import ffi, lib
-import sys
+
+logger = logging.getLogger(__name__)
 
 def encrypt(message, password):
     # Create 16 byte random salt
@@ -23,7 +26,7 @@ def encrypt(message, password):
                          lib.crypto_pwhash_opslimit_moderate(),
                          lib.crypto_pwhash_memlimit_moderate(),
                          lib.crypto_pwhash_alg_default()) != 0:
-        print("Out of memory")
+        logger.error("Out of memory")
         return None
 
     ciphertext = ffi.new("unsigned char[]",
@@ -51,7 +54,7 @@ def decrypt(salt, nonce, ciphertext, password):
                          lib.crypto_pwhash_opslimit_moderate(),
                          lib.crypto_pwhash_memlimit_moderate(),
                          lib.crypto_pwhash_alg_default()) != 0:
-        print("Out of memory")
+        logger.error("Out of memory")
         return None
 
     max_decrypted_size = (len(ciphertext) -
@@ -0,0 +1,167 @@
+import cProfile
+import collections
+import contextvars
+import logging
+import os
+import time
+
+import darkwallet.util
+
+logger = logging.getLogger(__name__)
+
+# Traces the next few RPC requests or background process cycles once
+# enabled with dw_trace or SIGUSR1. Span timings are written as
+# collapsed stacks ("dw_send;sign 1234", in
+# microseconds of self time) which flamegraph.pl and speedscope read.
+# With profiling on, a cProfile dump is written next to them.
+
+# Stack of span names for the trace running in this task.
+_path = contextvars.ContextVar("trace_path", default=None)
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_span = _NullSpan()
+
+class Trace:
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.is_finished = False
+        # path: inclusive seconds
+        self.spans = collections.defaultdict(float)
+
+    def folded(self):
+        # Flame graphs stack self time, so take each span's children
+        # off. Concurrent children can add up to more than their
+        # parent, which would go negative.
+        self_times = dict(self.spans)
+        for path, elapsed in self.spans.items():
+            parent = path[:-1]
+            if parent in self_times:
+                self_times[parent] -= elapsed
+        return ["%s %s" % (";".join(path), int(max(elapsed, 0) * 1000000))
+                for path, elapsed in sorted(self_times.items())]
+
+class _Span:
+
+    def __init__(self, trace, name):
+        self._trace = trace
+        self._name = name
+
+    def __enter__(self):
+        trace, path = _path.get()
+        self._path = path + (self._name,)
+        self._token = _path.set((trace, self._path))
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._trace.spans[self._path] += time.perf_counter() - self._start
+        _path.reset(self._token)
+        return False
+
+class _Root:
+
+    def __init__(self, tracer, trace, profile):
+        self._tracer = tracer
+        self._trace = trace
+        self._profiler = None
+        if profile and not tracer.is_profiling:
+            # Only one profiler can run at a time. It sees everything
+            # else the event loop runs meanwhile too.
+            self._profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self._token = _path.set((self._trace, ()))
+        self._span = _Span(self._trace, self._trace.name)
+        self._span.__enter__()
+        if self._profiler is not None:
+            self._tracer.is_profiling = True
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._tracer.is_profiling = False
+        self._span.__exit__(*exc_info)
+        self._trace.is_finished = True
+        _path.reset(self._token)
+        self._tracer.write(self._trace, self._profiler)
+        return False
+
+class Tracer:
+
+    kinds = ("request", "process")
+
+    def __init__(self):
+        self.directory = None
+        self.is_profiling = False
+        # kind: traces left to take
+        self._remaining = dict.fromkeys(self.kinds, 0)
+        self._profile = False
+        self._written = 0
+
+    def enable(self, directory, count, kinds=kinds, profile=False):
+        self.directory = directory
+        self._profile = profile
+        for kind in self.kinds:
+            self._remaining[kind] = count if kind in kinds else 0
+        logger.info("Tracing the next %s %s. [profile=%s]",
+                    count, " and ".join(kinds), profile)
+
+    def disable(self):
+        self._remaining = dict.fromkeys(self.kinds, 0)
+
+    def start(self, kind, name):
+        if not self._remaining[kind] or _current() is not None:
+            return _null_span
+        self._remaining[kind] -= 1
+        return _Root(self, Trace(kind, name), self._profile)
+
+    def write(self, trace, profiler=None):
+        darkwallet.util.make_sure_dir_exists(self.directory)
+        self._written += 1
+        basename = os.path.join(self.directory, "%s-%s-%s-%s" % (
+            int(time.time()), self._written, trace.kind, trace.name))
+        with open(basename + ".folded", "w") as folded_file:
+            folded_file.write("\n".join(trace.folded()) + "\n")
+        if profiler is not None:
+            profiler.dump_stats(basename + ".prof")
+        logger.info("Wrote trace: %s", basename)
+
+tracer = Tracer()
+
+def _current():
+    # Tasks started during a trace can outlive it.
+    current = _path.get()
+    if current is None or current[0].is_finished:
+        return None
+    return current
+
+def detach():
+    # Long running tasks inherit the context they were started from.
+    _path.set(None)
+
+def request(command):
+    return tracer.start("request", command)
+
+def cycle(process_name):
+    return tracer.start("process", process_name)
+
+def span(name):
+    # Cheap when nothing is being traced: one context variable lookup.
+    current = _current()
+    if current is None:
+        return _null_span
+    return _Span(current[0], name)
+
+def directory(settings):
+    return os.path.join(settings.config_path, "traces")
@@ -14,9 +14,10 @@ def _config_template():
     return os.path.join(sys.path[0], "darkwallet.cfg")
 
 def make_sure_file_exists(filename):
-    if not os.path.isfile(filename):
-        print("Initializing new darkwallet.cfg.")
-        shutil.copyfile(_config_template(), filename)
+    if os.path.isfile(filename):
+        return False
+    shutil.copyfile(_config_template(), filename)
+    return True
 
 def list_files(path):
     return [filename for filename in os.listdir(path)
@@ -1,21 +1,29 @@
 import asyncio
+import collections
+import concurrent.futures
+import csv
+import datetime
 import enum
+import hashlib
+import hmac
+import io
 import json
+import logging
 import os
 import random
-import sys
-from decimal import Decimal
 
-import libbitcoin.server
-from libbitcoin.server_fake_async import Client as FakeAsyncClient
-from libbitcoin.server import Client
+import darkwallet.blockchain
+import darkwallet.tracing as tracing
 import darkwallet.util
 from libbitcoin import bc
 from darkwallet.stealth import StealthReceiver, StealthSender
 from darkwallet.address_validator import AddressValidator
+from darkwallet import coin_selection
 
 import darkwallet.db as db
 
+logger = logging.getLogger(__name__)
+
 flatten = lambda l: [item for sublist in l for item in sublist]
 
 def write_json(filename, json_object):
@@ -34,9 +42,6 @@ def hd_private_key_to_address(key, is_testnet):
     assert address.is_valid()
     return str(address)
 
-def decimal_to_satoshi(value):
-    return int(value * (10**bc.btc_decimal_places))
-
 class ErrorCode(enum.Enum):
     wrong_password = 1
     invalid_brainwallet = 2
@@ -47,12 +52,130 @@ class ErrorCode(enum.Enum):
     invalid_address = 7
     short_password = 8
     updating_history = 9
+    account_not_open = 10
+    invalid_format = 11
+    invalid_fee_rate = 12
+    bad_parameters = 13
+
+class KeyEntry:
+
+    def __init__(self, pocket_name, index, secret):
+        self.pocket_name = pocket_name
+        # None for keys from stealth payments.
+        self.index = index
+        self.secret = secret
+        self.public_key = secret.to_public().data
+
+class KeyIndex:
+
+    # Every key in the account by address, kept in memory so finding
+    # the key for an address doesn't need to query each pocket.
+
+    def __init__(self):
+        self._entries = {}
+        # pocket name: [address, ...] ordered by key index
+        self._addresses = collections.defaultdict(list)
+        # pocket name: bitmap of key indexes with history
+        self._used = collections.defaultdict(int)
+
+    def load(self, account_model):
+        self._entries.clear()
+        self._addresses.clear()
+        self._used.clear()
+        rows = db.PocketKeys.select(db.PocketKeys, db.Pocket).join(
+            db.Pocket).where(db.Pocket.account == account_model)
+        for row in rows:
+            self.add(row.address, row.pocket.name, row.index_, row.secret)
+        rows = db.PocketStealthKeys.select(
+            db.PocketStealthKeys, db.Pocket).join(db.Pocket).where(
+            db.Pocket.account == account_model)
+        for row in rows:
+            self.add(row.address, row.pocket.name, None, row.secret)
+
+        query = db.History.select(db.History.address).where(
+            db.History.account == account_model).distinct()
+        for address, in _raw_rows(query):
+            self.set_used(address, True)
+
+    def add(self, address, pocket_name, index, secret):
+        address = str(address)
+        self._entries[address] = KeyEntry(pocket_name, index, secret)
+        if index is None:
+            return
+        addresses = self._addresses[pocket_name]
+        if index >= len(addresses):
+            addresses.extend([None] * (index + 1 - len(addresses)))
+        addresses[index] = address
+
+    # ------------------------------------------------
+    # Used addresses.
+    # ------------------------------------------------
+
+    def set_used(self, address, is_used):
+        entry = self.get(address)
+        if entry is None or entry.index is None:
+            return
+        bit = 1 << entry.index
+        if is_used:
+            self._used[entry.pocket_name] |= bit
+        else:
+            self._used[entry.pocket_name] &= ~bit
+
+    def clear_used(self):
+        self._used.clear()
+
+    def is_used(self, address):
+        entry = self.get(address)
+        if entry is None or entry.index is None:
+            return False
+        return bool(self._used[entry.pocket_name] >> entry.index & 1)
+
+    def max_used_index(self, pocket_name):
+        return self._used[pocket_name].bit_length() - 1
+
+    def next_unused_index(self, pocket_name):
+        used = self._used[pocket_name]
+        # Lowest clear bit.
+        return (~used & (used + 1)).bit_length() - 1
+
+    def unused_addresses(self, pocket_name):
+        used = self._used[pocket_name]
+        addresses = self._addresses[pocket_name]
+        start = self.next_unused_index(pocket_name)
+        return [address for index, address
+                in enumerate(addresses[start:], start)
+                if not used >> index & 1]
+
+    def random_unused_address(self, pocket_name):
+        used = self._used[pocket_name]
+        addresses = self._addresses[pocket_name]
+        start = self.next_unused_index(pocket_name)
+        if start >= len(addresses):
+            return None
+        # Almost every key after the first unused one is unused too.
+        for _ in range(8):
+            index = random.randrange(start, len(addresses))
+            if not used >> index & 1:
+                return addresses[index]
+        return addresses[start]
+
+    def get(self, address):
+        return self._entries.get(str(address))
+
+    def __contains__(self, address):
+        return str(address) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
 
 class AccountModel:
 
     def __init__(self, filename):
         self._filename = filename
         self._model = None
+        self.keys = KeyIndex()
+        # payment id: points its transaction spends, parsed once.
+        self._pending_points = {}
 
     def create(self, wordlist, is_testnet):
         try:
@@ -68,8 +191,14 @@ class AccountModel:
             self._model = db.Account.get()
         except (db.ImproperlyConfigured, db.DatabaseError):
             return False
+        db.migrate()
+        self.keys.load(self._model)
         return True
 
+    @property
+    def name(self):
+        return os.path.basename(self._filename)
+
     @property
     def current_index(self):
         if self.current_height is None:
@@ -126,13 +255,13 @@ class AccountModel:
         index = len(self.pocket_names)
         key = self.root_key.derive_private(index + bc.hd_first_hardened_key)
 
-        return PocketModel.create(self._model, name, index, key)
+        return PocketModel.create(self._model, name, index, key, self.keys)
 
     def pocket(self, name):
         if name not in self.pocket_names:
             return None
         model = db.Pocket.get(db.Pocket.name == name)
-        return PocketModel(model)
+        return PocketModel(model, self.keys)
 
     @property
     def pocket_names(self):
@@ -140,44 +269,100 @@ class AccountModel:
 
     @property
     def pockets(self):
-        return [PocketModel(model) for model in self._model.pockets]
+        return [PocketModel(model, self.keys) for model in self._model.pockets]
 
     def delete_pocket(self, name):
         del self._model["pockets"][name]
 
     @property
     def cache(self):
-        return CacheModel(self._model)
-
-    def all_unspent_inputs(self):
-        rows = db.History.select().where(db.History.spend == None,
-                                         db.History.is_output == True,
-                                         db.History.account == self._model)
-        return [HistoryRowModel(row).to_input() for row in rows]
+        return CacheModel(self._model, self.keys)
+
+    def unspent_outputs(self, pocket=None):
+        # [((encoded tx hash, index), value), ...] smallest first, as
+        # stored. Only the outputs chosen to spend get parsed.
+        query = db.History.select(
+            db.History.hash, db.History.index_, db.History.value).where(
+            db.History.spend == None, db.History.is_output == True,
+            db.History.account == self._model)
+        if pocket is not None:
+            query = query.where(db.History.pocket == pocket.model)
+        query = query.order_by(db.History.value)
+        return [((tx_hash, index), value)
+                for tx_hash, index, value in _raw_rows(query)]
 
     def find_key(self, address):
-        for pocket in self.pockets:
-            key = pocket.key_from_address(address)
-            if key is not None:
-                return key
-        return None
+        entry = self.keys.get(address)
+        if entry is None:
+            return None
+        return entry.secret
+
+    def history_pages(self, pocket=None, page_size=1000):
+        # Walks the history in id order a page at a time, so memory
+        # use doesn't grow with the size of the wallet.
+        last_id = 0
+        while True:
+            query = HistoryRecord.select().where(
+                db.History.account == self._model, db.History.id > last_id)
+            if pocket is not None:
+                query = query.where(db.History.pocket == pocket.model)
+            records = HistoryRecord.load(
+                query.order_by(db.History.id).limit(page_size))
+            if not records:
+                return
+            yield records
+            last_id = records[-1].id
+
+    def transaction_fees(self, tx_hashes):
+        # Fees for transactions spending only our outputs. Without
+        # the value of every input the fee can't be known.
+        tx_hashes = [str(tx_hash) for tx_hash in tx_hashes]
+        if not tx_hashes:
+            return {}
+        # tx hash: (value spent, inputs of ours)
+        spent = {}
+        for chunk in db.chunks(tx_hashes):
+            query = db.History.select(
+                db.History.hash, db.fn.SUM(db.History.value),
+                db.fn.COUNT(db.History.id)).where(
+                db.History.account == self._model,
+                db.History.is_output == False,
+                db.History.hash << chunk).group_by(db.History.hash)
+            for tx_hash, total, count in _raw_rows(query):
+                spent[tx_hash] = -total, count
+
+        fees = {}
+        transactions = self.cache.transactions.many(tx_hashes)
+        for tx_hash, tx in transactions.items():
+            if tx_hash not in spent:
+                continue
+            value, count = spent[tx_hash]
+            if count != len(tx.inputs()):
+                continue
+            fee = value - sum(output.value() for output in tx.outputs())
+            if fee >= 0:
+                fees[tx_hash] = fee
+        return fees
 
     def payment_address_version(self):
         return self._model.payment_address_version()
 
-    def save_pending_transaction(self, dests, tx, pocket):
+    def save_pending_transaction(self, dests, tx, pocket,
+                                 next_broadcast=None):
         pocket_model = pocket.model if pocket else None
 
+        # It was broadcast just before being saved.
         pending_tx = db.SentPayments.create(
             tx_hash=tx.hash(),
             tx=tx,
             account=self._model,
-            pocket=pocket_model
+            pocket=pocket_model,
+            broadcast_attempts=1,
+            last_broadcast=datetime.datetime.now(),
+            next_broadcast=next_broadcast
         )
 
         for address, value in dests:
-            value = Decimal(
-                bc.encode_base10(value, bc.btc_decimal_places))
             db.SentPaymentDestinations.create(
                 parent=pending_tx,
                 address=address,
@@ -185,30 +370,96 @@ class AccountModel:
             )
 
     def mark_any_confirmed_sent_payments(self):
-        sent_rows = db.SentPayments.select().join(
-            db.History, on=(
-                db.SentPayments.tx_hash == db.History.hash))
-
-        for row in sent_rows:
-            row.is_confirmed = True
-            row.save()
+        # Only unconfirmed payments are looked at, each through the
+        # history hash index, so the cost follows the pending count.
+        mined = db.History.select(db.History.height).where(
+            db.History.hash == db.SentPayments.tx_hash,
+            db.History.height > 0)
+        query = db.SentPayments.update(
+            is_confirmed=True,
+            confirmed_height=mined.select(db.fn.MIN(db.History.height))).where(
+            db.SentPayments.account == self._model,
+            db.SentPayments.is_confirmed == False,
+            db.fn.EXISTS(mined))
+        return query.execute()
 
     def all_pending_payments(self):
         pending = db.SentPayments.select().where(
             db.SentPayments.is_confirmed == False)
         return [PendingPaymentModel(payment) for payment in pending]
 
+    def due_rebroadcasts(self, limit):
+        due = db.SentPayments.select().where(
+            db.SentPayments.account == self._model,
+            db.SentPayments.is_confirmed == False,
+            (db.SentPayments.next_broadcast >> None) |
+            (db.SentPayments.next_broadcast <= datetime.datetime.now()))
+        due = due.order_by(db.SentPayments.next_broadcast).limit(limit)
+        return [PendingPaymentModel(payment) for payment in due]
+
+    def pending_spent_points(self):
+        # Outputs spent by our unconfirmed payments, which history
+        # won't show as spent until it's next updated. Each payment's
+        # transaction is only loaded and parsed the first time.
+        query = db.SentPayments.select(db.SentPayments.id).where(
+            db.SentPayments.account == self._model,
+            db.SentPayments.is_confirmed == False)
+        pending_ids = set(payment_id for payment_id, in _raw_rows(query))
+
+        new_ids = pending_ids - set(self._pending_points)
+        for chunk in db.chunks(new_ids):
+            payments = db.SentPayments.select().where(
+                db.SentPayments.id << chunk)
+            for payment in payments:
+                points = set()
+                for input in payment.tx.inputs():
+                    point = input.previous_output()
+                    points.add((str(point.hash()), point.index()))
+                self._pending_points[payment.id] = points
+        for payment_id in set(self._pending_points) - pending_ids:
+            del self._pending_points[payment_id]
+
+        points = set()
+        for payment_points in self._pending_points.values():
+            points |= payment_points
+        return points
+
+    def queue_payout(self, address, value, pocket):
+        pocket_model = pocket.model if pocket else None
+        db.QueuedPayouts.create(
+            account=self._model,
+            pocket=pocket_model,
+            address=address,
+            value=value
+        )
+
+    def queued_payouts(self):
+        rows = db.QueuedPayouts.select().where(
+            db.QueuedPayouts.account == self._model)
+        rows = rows.order_by(db.QueuedPayouts.id)
+        return [QueuedPayoutModel(row) for row in rows]
+
+    def remove_queued_payouts(self, payouts):
+        ids = [payout.id for payout in payouts]
+        query = db.QueuedPayouts.delete().where(db.QueuedPayouts.id << ids)
+        query.execute()
+
 class PocketModel:
 
-    def __init__(self, model):
+    def __init__(self, model, keys):
         self._model = model
+        self._keys = keys
+
+    @property
+    def name(self):
+        return self._model.name
 
     @property
     def is_testnet(self):
         return self._model.is_testnet
 
     @classmethod
-    def create(cls, account_model, name, index, key):
+    def create(cls, account_model, name, index, key, keys):
         version = account_model.payment_address_version()
         scan_key, spend_key = PocketModel._derive_stealth_keys(key)
         stealth_addr = PocketModel._derive_stealth_address(
@@ -223,7 +474,8 @@ class PocketModel:
             stealth_scan_key=scan_key,
             stealth_spend_key=spend_key
         )
-        return cls(pocket_model)
+        db.PocketBalance.create(pocket=pocket_model)
+        return cls(pocket_model, keys)
 
     @staticmethod
     def _derive_stealth_keys(key):
@@ -245,42 +497,33 @@ class PocketModel:
     def index(self):
         return self._model.index_
 
-    def add_key(self):
-        index = self.number_normal_keys()
-        key = self.main_key.derive_private(index + bc.hd_first_hardened_key)
-        address = hd_private_key_to_address(key, self.is_testnet)
-
-        db.PocketKeys.create(
-            pocket=self._model,
-            index_=index,
-            address=address,
-            key=key
-        )
+    def add_keys(self, count):
+        # Returns the new addresses.
+        start = self.number_normal_keys()
+        addresses = []
+        with db.db.atomic():
+            for index in range(start, start + count):
+                key = self.main_key.derive_private(
+                    index + bc.hd_first_hardened_key)
+                address = hd_private_key_to_address(key, self.is_testnet)
+
+                db.PocketKeys.create(
+                    pocket=self._model,
+                    index_=index,
+                    address=address,
+                    key=key
+                )
+                self._keys.add(address, self.name, index, key.secret())
+                addresses.append(bc.PaymentAddress.from_string(address))
+        return addresses
 
-    def _get_secret(self, address):
-        try:
-            key_model = db.PocketKeys.get(db.PocketKeys.address == address,
-                                          db.PocketKeys.pocket == self._model)
-        except db.DoesNotExist:
+    def key_from_address(self, address):
+        entry = self._keys.get(address)
+        if entry is None:
             return None
-        return key_model.secret
-
-    def _get_stealth_secret(self, address):
-        try:
-            key_model = db.PocketStealthKeys.get(
-                db.PocketStealthKeys.address == address)
-        except db.DoesNotExist:
+        if entry.index is not None and entry.pocket_name != self.name:
             return None
-        return key_model.secret
-
-    def key_from_address(self, address):
-        secret = self._get_secret(address)
-        if secret is not None:
-            return secret
-        stealth_secret = self._get_stealth_secret(address)
-        if stealth_secret is not None:
-            return stealth_secret
-        return None
+        return entry.secret
 
     @property
     def addrs(self):
@@ -298,13 +541,25 @@ class PocketModel:
             db.PocketStealthKeys.pocket == self._model)
         return [row.address for row in rows]
 
+    def unused_addrs(self):
+        return self._keys.unused_addresses(self.name)
+
+    def random_unused_addr(self):
+        address = self._keys.random_unused_address(self.name)
+        if address is None:
+            # Every key is used until the gap limit is topped up again,
+            # so derive the next one rather than reuse an address.
+            address = self.add_keys(1)[0].encoded()
+        return address
+
+    def max_used_index(self):
+        return self._keys.max_used_index(self.name)
+
     def address_index(self, address):
-        try:
-            key_model = db.PocketKeys.get(db.PocketKeys.address == address)
-        except db.DoesNotExist:
+        entry = self._keys.get(address)
+        if entry is None:
             return None
-
-        return key_model.index_
+        return entry.index
 
     @property
     def stealth_scan_private(self):
@@ -327,36 +582,35 @@ class PocketModel:
     def stealth_address(self):
         return self.stealth_receiver.generate_stealth_address()
 
-    def _stealth_key_entry_exists(self, address):
-        try:
-            db.PocketStealthKeys.get(db.PocketStealthKeys.address == address)
-        except db.DoesNotExist:
-            return False
-        return True
-
     def add_stealth_key(self, address, key):
-        if self._stealth_key_entry_exists(address):
+        if address in self._keys:
             return
         db.PocketStealthKeys.create(pocket=self._model, address=address,
                                     secret=key)
+        self._keys.add(address, self.name, None, key)
 
     def number_normal_keys(self):
-        return len(db.PocketKeys.select().where(
-            db.PocketKeys.pocket == self._model))
+        return db.PocketKeys.select().where(
+            db.PocketKeys.pocket == self._model).count()
 
     @property
     def history(self):
-        return [HistoryRowModel(row) for row in self._model.history]
+        query = HistoryRecord.select().where(
+            db.History.pocket == self._model)
+        return HistoryRecord.load(query, spends=True)
+
+    def _balance_row(self):
+        return db.PocketBalance.get(db.PocketBalance.pocket == self._model)
 
     def balance(self):
-        return sum(row.value for row in self.history)
+        row = self._balance_row()
+        return row.confirmed + row.unconfirmed
 
-    @property
-    def unspent_inputs(self):
-        rows = db.History.select().where(db.History.spend == None,
-                                         db.History.is_output == True,
-                                         db.History.pocket == self._model)
-        return [HistoryRowModel(row).to_input() for row in rows]
+    def confirmed_balance(self):
+        return self._balance_row().confirmed
+
+    def unconfirmed_balance(self):
+        return self._balance_row().unconfirmed
 
     @property
     def model(self):
@@ -370,12 +624,13 @@ class PocketModel:
 
 class CacheModel:
 
-    def __init__(self, account_model):
+    def __init__(self, account_model, keys):
         self._account_model = account_model
+        self._keys = keys
 
     @property
     def history(self):
-        return HistoryModel(self._account_model)
+        return HistoryModel(self._account_model, self._keys)
 
     @property
     def transactions(self):
@@ -387,33 +642,58 @@ class CacheModel:
 
 class HistoryModel:
 
-    def __init__(self, account_model):
+    def __init__(self, account_model, keys):
         self._account_model = account_model
+        self._keys = keys
 
     def clear(self):
         account = self._account_model
-        query = db.History.delete().where(db.History.account == account)
-        query.execute()
+        with db.db.atomic():
+            query = db.History.delete().where(db.History.account == account)
+            query.execute()
+            pockets = db.Pocket.select(db.Pocket.id).where(
+                db.Pocket.account == account)
+            query = db.PocketBalance.update(confirmed=0, unconfirmed=0).where(
+                db.PocketBalance.pocket << pockets)
+            query.execute()
+        self._keys.clear_used()
 
     def __getitem__(self, address):
-        rows = db.History.select().where(db.History.address == address)
-        return [HistoryRowModel(row) for row in rows]
+        query = HistoryRecord.select().where(db.History.address == address)
+        return HistoryRecord.load(query, spends=True)
 
     def set(self, address, history, pocket):
+        with db.db.atomic():
+            self._set(address, history, pocket)
+        self._keys.set_used(address, bool(history))
+
+    def set_many(self, entries):
+        # [(address, history, pocket), ...] in one transaction.
+        with db.db.atomic():
+            for address, history, pocket in entries:
+                self._set(address, history, pocket)
+        for address, history, pocket in entries:
+            self._keys.set_used(address, bool(history))
+
+    def _set(self, address, history, pocket):
+        # Satoshis added to the pocket balance by height.
+        changes = collections.Counter()
+        rows = db.History.select(db.History.height, db.History.value).where(
+            db.History.address == address, db.History.pocket == pocket.model)
+        for row in rows:
+            changes[row.height] -= row.value
         self._delete_entries(address, pocket)
 
         for output, spend in history:
             output_hash = bc.HashDigest.from_bytes(output[0].hash[::-1])
 
             value = output[2]
-            output_value = Decimal(
-                bc.encode_base10(value, bc.btc_decimal_places))
 
             if spend is None:
                 spend = None
             else:
                 spend_hash = bc.HashDigest.from_bytes(spend[0].hash[::-1])
-                spend_value = -output_value
+                changes[spend[1]] -= value
 
                 spend = db.History.create(
                     account=self._account_model,
@@ -426,7 +706,7 @@ class HistoryModel:
                     index_=spend[0].index,
                     height=spend[1],
 
-                    value=spend_value
+                    value=-value
                 )
 
             db.History.create(
@@ -441,8 +721,23 @@ class HistoryModel:
                 index_=output[0].index,
                 height=output[1],
 
-                value=output_value
+                value=value
             )
+            changes[output[1]] += value
+
+        self._update_balance(pocket, changes)
+
+    def _update_balance(self, pocket, changes):
+        confirmed = sum(value for height, value in changes.items() if height)
+        unconfirmed = changes[0]
+        if not confirmed and not unconfirmed:
+            return
+        balance = db.PocketBalance
+        query = balance.update(
+            confirmed=balance.confirmed + confirmed,
+            unconfirmed=balance.unconfirmed + unconfirmed).where(
+            balance.pocket == pocket.model)
+        query.execute()
 
     def _delete_entries(self, address, pocket):
         query = db.History.delete().where(db.History.address == address,
@@ -454,8 +749,9 @@ class HistoryModel:
         return len(rows) > 0
 
     def values(self):
-        return [[HistoryRowModel(row) for row in history]
-                for history in self._model.values()]
+        addresses = db.History.select(db.History.address).where(
+            db.History.account == self._account_model).distinct()
+        return [self[address] for address, in _raw_rows(addresses)]
 
     def all(self, from_height=0):
         all_rows = flatten(self.values())
@@ -464,58 +760,79 @@ class HistoryModel:
 
     @property
     def transaction_hashes(self):
-        rows = db.History.select(db.History.hash)
-        return [row.hash for row in rows]
+        query = db.History.select(db.History.hash).where(
+            db.History.account == self._account_model)
+        return [bc.hash_literal(tx_hash) for tx_hash, in _raw_rows(query)]
 
-class HistoryRowModel:
+def _raw_rows(query):
+    # Column values as stored, without the fields' conversions.
+    sql, params = query.sql()
+    return db.db.execute_sql(sql, params).fetchall()
 
-    def __init__(self, model):
-        self._model = model
+class HistoryRecord:
 
-    @property
-    def model(self):
-        return self._model
+    # A history row kept as stored. Hashes and addresses are only
+    # parsed if asked for, since most reads never touch most of them.
 
-    @property
-    def is_output(self):
-        return self._model.is_output
+    __slots__ = ("id", "pocket_id", "encoded_address", "is_output",
+                 "spend_id", "encoded_hash", "index", "height", "value",
+                 "_spend")
 
-    @property
-    def is_spend(self):
-        return not self.is_output
+    columns = (db.History.id, db.History.pocket, db.History.address,
+               db.History.is_output, db.History.spend, db.History.hash,
+               db.History.index_, db.History.height, db.History.value)
 
-    def is_spent_output(self):
-        return self.is_output() and self.spend is not None
+    def __init__(self, row):
+        self.id, self.pocket_id, self.encoded_address, is_output, \
+            self.spend_id, self.encoded_hash, self.index, self.height, \
+            self.value = row
+        self.is_output = bool(is_output)
+        self._spend = None
 
-    def is_unspent_output(self):
-        return self.is_output() and not self.is_spent_output()
+    @classmethod
+    def select(cls):
+        return db.History.select(*cls.columns)
 
-    def is_change_output(self):
-        if not self.is_output:
-            return False
-        try:
-            db.History.get(db.History.hash == self.hash,
-                           db.History.is_output == False,
-                           db.History.pocket == self._model.pocket)
-        except db.DoesNotExist:
-            return False
-        return True
+    @classmethod
+    def load(cls, query, spends=False):
+        records = [cls(row) for row in _raw_rows(query)]
+        if spends:
+            cls._load_spends(records)
+        return records
 
-    @property
-    def hash(self):
-        return self._model.hash
+    @classmethod
+    def _load_spends(cls, records):
+        spend_ids = [record.spend_id for record in records
+                     if record.spend_id is not None]
+        spends = {}
+        for chunk in db.chunks(spend_ids):
+            for spend in cls.load(cls.select().where(
+                    db.History.id << chunk)):
+                spends[spend.id] = spend
+        for record in records:
+            if record.spend_id is not None:
+                record._spend = spends[record.spend_id]
 
     @property
-    def index(self):
-        return self._model.index_
+    def is_spend(self):
+        return not self.is_output
 
     @property
-    def height(self):
-        return self._model.height
+    def hash(self):
+        return bc.hash_literal(self.encoded_hash)
 
     @property
     def address(self):
-        return self._model.address
+        return bc.PaymentAddress.from_string(self.encoded_address)
+
+    @property
+    def spend(self):
+        if self.spend_id is None:
+            return None
+        if self._spend is None:
+            self._spend = self.load(self.select().where(
+                db.History.id == self.spend_id))[0]
+        return self._spend
 
     def type_string(self):
         if self.is_output:
@@ -524,39 +841,6 @@ class HistoryRowModel:
             return "spend"
         assert False
 
-    @property
-    def value(self):
-        value = self._model.value
-        return decimal_to_satoshi(value)
-
-    def value_minus_change(self):
-        if self.is_output:
-            return self.value
-        return self.value + self._change_value()
-
-    def _change_value(self):
-        assert self.is_spend
-        try:
-            change_rows = db.History.select().where(
-                db.History.hash == self.hash,
-                db.History.is_output == True,
-                db.History.pocket == self._model.pocket)
-        except db.DoesNotExist:
-            # No change output
-            return 0
-        return sum(HistoryRowModel(row).value for row in change_rows)
-
-    @property
-    def spend(self):
-        spend = self._model.spend
-        if spend is None:
-            return spend
-        return HistoryRowModel(spend)
-
-    def to_input(self):
-        assert self.is_output
-        return (self.hash, self.index), self.value
-
 class TrackAddressUpdatesModel:
 
     def __init__(self, account_model):
@@ -607,6 +891,25 @@ class TransactionCacheModel:
             tx=tx
         )
 
+    def set_many(self, transactions):
+        # [(tx_hash, tx), ...] in one transaction.
+        with db.db.atomic():
+            for tx_hash, tx in transactions:
+                self[tx_hash] = tx
+
+    def many(self, tx_hashes):
+        tx_hashes = [bc.encode_hash(tx_hash)
+                     if isinstance(tx_hash, bc.HashDigest) else tx_hash
+                     for tx_hash in tx_hashes]
+        transactions = {}
+        for chunk in db.chunks(tx_hashes):
+            rows = db.TransactionCache.select().where(
+                db.TransactionCache.hash << chunk)
+            for row in rows:
+                assert row.tx.is_valid()
+                transactions[bc.encode_hash(row.hash)] = row.tx
+        return transactions
+
     def __contains__(self, tx_hash):
         try:
             db.TransactionCache.get(db.TransactionCache.hash == tx_hash)
@@ -636,6 +939,50 @@ class PendingPaymentModel:
         return [(dest.address, dest.value) for dest
                 in self._model.destinations]
 
+    @property
+    def broadcast_attempts(self):
+        return self._model.broadcast_attempts
+
+    @property
+    def last_broadcast(self):
+        return self._model.last_broadcast
+
+    def schedule_broadcast(self, delay, broadcast=False):
+        now = datetime.datetime.now()
+        if broadcast:
+            self._model.broadcast_attempts += 1
+            self._model.last_broadcast = now
+        self._model.next_broadcast = now + datetime.timedelta(seconds=delay)
+        self._model.save(only=[db.SentPayments.broadcast_attempts,
+                               db.SentPayments.last_broadcast,
+                               db.SentPayments.next_broadcast])
+
+class QueuedPayoutModel:
+
+    def __init__(self, model):
+        self._model = model
+
+    @property
+    def id(self):
+        return self._model.id
+
+    @property
+    def address(self):
+        return self._model.address
+
+    @property
+    def value(self):
+        return self._model.value
+
+    @property
+    def pocket_name(self):
+        pocket = self._model.pocket
+        return None if pocket is None else pocket.name
+
+    @property
+    def created_date(self):
+        return self._model.created_date
+
 class Account:
 
     def __init__(self, name, filename, context, settings):
@@ -645,11 +992,34 @@ class Account:
 
         self._model = AccountModel(filename)
         self.client = None
+        self._controller = None
+        self._restore = None
+        self._restore_task = None
+        self._database = None
+        # A random key per account, so the digest kept in memory
+        # can't be looked up or compared across accounts.
+        self._password_key = os.urandom(32)
+        self._password_digest = None
 
         self._updating_history = False
+        # Sends must not pick the same outputs as each other.
+        self._send_lock = asyncio.Lock()
+        self._signing_executor = None
 
     def initialize_db(self, filename, password):
-        db.initialize(filename, password)
+        self._database = db.initialize(filename, password)
+        self._password_digest = self._digest(password)
+
+    def _digest(self, password):
+        return hmac.new(self._password_key, password.encode(),
+                        hashlib.sha256).digest()
+
+    def check_password(self, password):
+        return hmac.compare_digest(self._digest(password),
+                                   self._password_digest)
+
+    def activate(self):
+        db.activate(self._database)
 
     def brainwallet_wordlist(self):
         return self._model.wordlist
@@ -668,28 +1038,56 @@ class Account:
         return self._model.load()
 
     def stop(self):
-        self._controller.stop()
+        if self._restore_task is not None:
+            self._restore_task.cancel()
+            self._restore_task = None
+        if self._controller is not None:
+            self._controller.stop()
+            self._controller = None
+        if self._database is not None:
+            self._database.close()
+        if self._signing_executor is not None:
+            self._signing_executor.shutdown(wait=False)
+            self._signing_executor = None
+
+    @property
+    def is_testnet(self):
+        return self._model.is_testnet
 
-    def start_scanning(self):
-        self._connect()
+    def start_scanning(self, client):
+        self.client = client
+
+        # The processes inherit the active database from the
+        # context they are started in.
+        self.activate()
 
         from darkwallet.wallet_control import WalletControlProcess
         self._controller = WalletControlProcess(self.client, self._model,
-                                                self._settings)
+                                                self._settings, self)
+
+    def start_restore(self, client):
+        # Rebuild the history in bulk, then sync as usual.
+        self.client = client
+        self.activate()
+
+        from darkwallet.restore import RestorePipeline
+        self._restore = RestorePipeline(self.client, self._model,
+                                        self._settings)
+        self._updating_history = True
+        loop = asyncio.get_event_loop()
+        self._restore_task = loop.create_task(self._run_restore())
+
+    async def _run_restore(self):
+        tracing.detach()
+        await self._restore.run()
+        self._restore_task = None
+        self._updating_history = False
+        self.start_scanning(self.client)
 
-    def _connect(self):
-        client_settings = libbitcoin.server.ClientSettings()
-        client_settings.query_expire_time = self._settings.query_expire_time
-        client_settings.socks5 = self._settings.socks5
-        url = self._settings.url
-        if self._model.is_testnet:
-            url = self._settings.testnet_url
-        # Tornado implementation.
-        if self._settings.use_tornado_impl:
-            self.client = FakeAsyncClient(self._context, url, client_settings)
-        else:
-            self.client = self._context.Client(url, client_settings)
-        print("Connected to %s" % url)
+    def restore_status(self):
+        if self._restore is None:
+            return ErrorCode.not_found, None
+        return None, self._restore.status
 
     def list_pockets(self):
         return self._model.pocket_names
@@ -715,17 +1113,11 @@ class Account:
                         in self._model.pockets]
         return flatten(unused_addrs)
 
-    def _filter_unused(self, addrs):
-        return [address for address in addrs if not self.is_used(address)]
-
     def unused_addrs(self, pocket):
-        return [str(address) for address in
-                self._filter_unused(pocket.addrs_normal)]
+        return pocket.unused_addrs()
 
     def is_used(self, addr):
-        if addr in self._model.cache.history:
-            return True
-        return False
+        return self._model.keys.is_used(addr)
 
     def receive(self, pocket_name=None):
         if pocket_name is None:
@@ -788,24 +1180,40 @@ class Account:
         if pocket is None:
             return None
 
+        records = pocket.history
+        # Change is worked out from the rows already loaded rather than
+        # with two queries per row.
+        spend_hashes = set()
+        change = collections.defaultdict(int)
+        for record in records:
+            if record.is_spend:
+                spend_hashes.add(record.encoded_hash)
+        for record in records:
+            if record.is_output and record.encoded_hash in spend_hashes:
+                change[record.encoded_hash] += record.value
+
         history = []
-        for row in pocket.history:
-            if row.is_change_output():
+        for row in records:
+            if row.is_output and row.encoded_hash in spend_hashes:
                 continue
 
             obj = {
-                "hash": str(row.hash),
+                "hash": row.encoded_hash,
                 "index": row.index,
                 "height": row.height
             }
 
+            value = row.value
+            if row.is_spend:
+                value += change[row.encoded_hash]
+
             row_json = {
-                "addr": str(row.address),
+                "addr": row.encoded_address,
                 "type": row.type_string(),
 
                 "spend": None,
 
-                "value": row.value_minus_change()
+                "value": value
             }
 
             if row.is_output:
@@ -815,7 +1223,7 @@ class Account:
                     row_json["spend"] = None
                 else:
                     row_json["spend"] = {
-                        "hash": str(row.spend.hash),
+                        "hash": row.spend.encoded_hash,
                         "index": row.spend.index,
                         "height": row.spend.height
                     }
@@ -826,6 +1234,75 @@ class Account:
 
         return history
 
+    export_formats = ("csv", "jsonl")
+    _export_fields = ("txid", "height", "pocket", "address", "value", "fee")
+
+    def export_history(self, pocket_name=None, format="csv"):
+        if self._updating_history:
+            return ErrorCode.updating_history, None
+        if format not in self.export_formats:
+            return ErrorCode.invalid_format, None
+
+        pocket = None
+        if pocket_name is not None:
+            pocket = self._model.pocket(pocket_name)
+            if pocket is None:
+                return ErrorCode.not_found, None
+
+        return None, self._export_chunks(pocket, format)
+
+    def _export_chunks(self, pocket, format):
+        if format == "csv":
+            yield ",".join(self._export_fields) + "\n"
+
+        pocket_names = {pocket_model.model.id: pocket_model.name
+                        for pocket_model in self._model.pockets}
+
+        # A transaction's fee goes on its first spend row only, so
+        # the fee column adds up.
+        fees_written = set()
+
+        for rows in self._model.history_pages(pocket):
+            fees = self._model.transaction_fees(set(
+                row.encoded_hash for row in rows if not row.is_output))
+
+            records = []
+            for row in rows:
+                tx_hash = row.encoded_hash
+                fee = None
+                if not row.is_output and tx_hash not in fees_written:
+                    fees_written.add(tx_hash)
+                    fee = fees.get(tx_hash)
+                records.append((tx_hash, row.height,
+                                pocket_names[row.pocket_id],
+                                row.encoded_address, row.value, fee))
+
+            if format == "csv":
+                output = io.StringIO()
+                csv.writer(output, lineterminator="\n").writerows(records)
+                yield output.getvalue()
+            else:
+                yield "".join(
+                    json.dumps(dict(zip(self._export_fields, record))) + "\n"
+                    for record in records)
+
+    async def export_history_to_file(self, pocket_name=None, format="csv"):
+        ec, chunks = self.export_history(pocket_name, format)
+        if ec:
+            return ec, None
+
+        path = os.path.join(self._settings.config_path, "exports")
+        darkwallet.util.make_sure_dir_exists(path)
+        filename = os.path.join(path, "%s-%s.%s" % (
+            self.name, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+            format))
+        with open(filename, "w") as export_file:
+            for chunk in chunks:
+                export_file.write(chunk)
+                # Let other requests run between pages.
+                await asyncio.sleep(0)
+        return None, filename
+
     async def get_height(self):
         return await self.client.last_height()
 
@@ -846,66 +1323,187 @@ class Account:
 
         return validator.is_p2kh()
 
-    async def send(self, dests, from_pocket, fee):
+    async def send(self, dests, from_pocket, fee=None, payouts=None):
         if self._updating_history:
             return ErrorCode.updating_history, []
 
         for address, value in dests:
             if not self._is_correct_address(address):
                 return ErrorCode.invalid_address, None
-        # Input:
-        #   [(point, value), ...]
-        #   minimum_value
-        # Returns:
-        #   [point, ...], change
 
-        # If no pocket, select all unspent
-        unspent = self._unspent_inputs(from_pocket)
+        async with self._send_lock:
+            with tracing.span("select"):
+                index = self._unspent_index(from_pocket)
 
-        # Amount that we are sending + the fee we will pay.
-        minimum_value = sum(value for addr, value in dests) + fee
+                # Without a fee given, pay the configured fee rate.
+                selection = self._select_outputs(index, dests, fee)
+            if selection is None:
+                return ErrorCode.not_enough_funds, None
 
-        out = self._select_outputs(unspent, minimum_value)
-        if out is None:
-            return ErrorCode.not_enough_funds, None
+            return await self._send_selection(selection, dests, from_pocket,
+                                              payouts)
 
-        tx = await self._build_transaction(out, dests, from_pocket)
+    async def _send_selection(self, selection, dests, from_pocket,
+                              payouts=None):
+        with tracing.span("build"):
+            tx = await self._build_transaction(selection, dests, from_pocket)
 
         # signature, input
-        await self._sign(tx)
+        with tracing.span("sign"):
+            await self._sign(tx)
 
-        print("Broadcasting:", tx.to_data().hex())
-        ec = await self.client.broadcast(tx.to_data())
+        tx_data = tx.to_data()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Broadcasting: %s", tx_data.hex())
+        ec = await self.client.broadcast(tx_data)
         if ec:
+            logger.warning("Broadcasting %s: %s", tx.hash(), ec)
             return ec, None
 
-        self._save_pending_transaction(dests, tx, from_pocket)
+        with tracing.span("save"):
+            self._save_pending_transaction(dests, tx, from_pocket, payouts)
 
         return None, bc.encode_hash(tx.hash())
 
-    def _unspent_inputs(self, from_pocket):
+    def _unspent_index(self, from_pocket):
+        # If no pocket, select from all unspent outputs.
         pocket = self._model.pocket(from_pocket)
-        if pocket is None:
-            return self._model.all_unspent_inputs()
-        return pocket.unspent_inputs
+        unspent = self._model.unspent_outputs(pocket)
+        spent = self._model.pending_spent_points()
+        if spent:
+            unspent = [utxo for utxo in unspent if utxo[0] not in spent]
+        # Already sorted by value.
+        return coin_selection.UtxoIndex(unspent, is_sorted=True)
+
+    # ------------------------------------------------
+    # Batched payouts and consolidation.
+    # ------------------------------------------------
+
+    def queue_payment(self, dests, pocket_name=None):
+        for address, value in dests:
+            if not self._is_correct_address(address):
+                return ErrorCode.invalid_address, []
+
+        pocket = None
+        if pocket_name is not None:
+            pocket = self._model.pocket(pocket_name)
+            if pocket is None:
+                return ErrorCode.not_found, []
+
+        with db.db.atomic():
+            for address, value in dests:
+                self._model.queue_payout(address, value, pocket)
+        return None, [len(self._model.queued_payouts())]
+
+    def queued_payments(self):
+        return None, [{
+            "address": payout.address,
+            "value": payout.value,
+            "pocket": payout.pocket_name,
+            "created_date": payout.created_date.strftime("%d %b %Y %H:%M")
+            } for payout in self._model.queued_payouts()]
+
+    def _batch_is_due(self, payouts):
+        if len(payouts) >= self._settings.payout_batch_size:
+            return True
+        age = datetime.datetime.now() - payouts[0].created_date
+        return age.total_seconds() >= self._settings.payout_batch_age
 
-    def _select_outputs(self, unspent, minimum_value):
-        out = bc.select_outputs(unspent, minimum_value)
-        if not out.points:
-            return None
-        return out
+    async def flush_payouts(self, force=False):
+        if self._updating_history:
+            return ErrorCode.updating_history, []
+
+        # Payouts from the same pocket go out together.
+        batches = collections.OrderedDict()
+        for payout in self._model.queued_payouts():
+            batches.setdefault(payout.pocket_name, []).append(payout)
+
+        tx_hashes = []
+        batch_size = self._settings.payout_batch_size
+        for pocket_name, payouts in batches.items():
+            if not force and not self._batch_is_due(payouts):
+                continue
+            for i in range(0, len(payouts), batch_size):
+                batch = payouts[i:i + batch_size]
+                dests = [(payout.address, payout.value) for payout in batch]
+                ec, tx_hash = await self.send(dests, pocket_name,
+                                              payouts=batch)
+                if ec:
+                    # Leave them queued for the next flush.
+                    logger.error("Flushing payouts: %s", ec)
+                    return ec, tx_hashes
+                logger.info("Sent batch of %s payouts.", len(batch))
+                tx_hashes.append(tx_hash)
+        return None, tx_hashes
+
+    def consolidation_count(self, pocket_name):
+        # Outputs which the next consolidation would sweep.
+        index = self._unspent_index(pocket_name)
+        input_fee = self._settings.consolidate_fee_rate * \
+            coin_selection.INPUT_SIZE
+        count = (index.count_below(self._settings.consolidate_below) -
+                 index.count_below(input_fee))
+        return min(count, self._settings.consolidate_max_inputs)
+
+    async def consolidate(self, pocket_name, fee_rate=None):
+        if self._updating_history:
+            return ErrorCode.updating_history, None
+
+        pocket = self._model.pocket(pocket_name)
+        if pocket is None:
+            return ErrorCode.not_found, None
 
-    async def _build_transaction(self, out, dests, change_pocket=None):
+        # consolidate-fee-rate is only for automatic consolidation,
+        # where 0 turns it off.
+        if fee_rate is None:
+            fee_rate = self._settings.fee_rate
+        # bool is a subclass of int, so True would pass as 1.
+        if (isinstance(fee_rate, bool) or not isinstance(fee_rate, int) or
+                fee_rate <= 0):
+            return ErrorCode.invalid_fee_rate, None
+
+        async with self._send_lock:
+            index = self._unspent_index(pocket_name)
+            selection = coin_selection.select_consolidation(
+                index, int(fee_rate),
+                int(self._settings.consolidate_below),
+                int(self._settings.consolidate_max_inputs))
+            if selection is None:
+                return ErrorCode.not_enough_funds, None
+
+            logger.info("Consolidating %s outputs.", len(selection.utxos))
+            # Everything comes back to the pocket as change.
+            return await self._send_selection(selection, [], pocket_name)
+
+    def _select_outputs(self, index, dests, fee=None):
+        output_sizes = [
+            coin_selection.output_size(AddressValidator(addr).is_stealth())
+            for addr, value in dests]
+        fee_rate = 0 if fee is not None else int(self._settings.fee_rate)
+
+        selector = coin_selection.CoinSelector(
+            index, fee_rate, self._settings.coin_selection)
+
+        amount = sum(value for addr, value in dests)
+        return selector.select(amount, output_sizes, fee)
+
+    def _output_points(self, selection):
+        return [bc.OutputPoint(bc.hash_literal(tx_hash), index)
+                for (tx_hash, index), value in selection.utxos]
+
+    async def _build_transaction(self, selection, dests, change_pocket=None):
         tx = bc.Transaction()
         tx.set_version(1)
         tx.set_locktime(0)
 
-        inputs = [self._create_input(point) for point in out.points]
+        inputs = [self._create_input(point) for point
+                  in self._output_points(selection)]
         tx.set_inputs(inputs)
 
         outputs = [self._create_outputs(addr, value) for addr, value in dests]
-        if out.change:
-            outputs += [self._create_change_output(change_pocket, out.change)]
+        if selection.change:
+            outputs += [self._create_change_output(change_pocket,
+                                                   selection.change)]
         random.shuffle(outputs)
         outputs = flatten(outputs)
         tx.set_outputs(outputs)
@@ -965,10 +1563,9 @@ class Account:
         output = bc.Output()
         output.set_value(change_value)
 
-        unused_addrs = self.unused_addrs(pocket)
         # Send change to random unspent address in pocket
         address = bc.PaymentAddress.from_string(
-            random.choice(unused_addrs))
+            pocket.random_unused_addr())
         script = bc.Script.from_ops(
             bc.Script.to_pay_key_hash_pattern(address.hash()))
         output.set_script(script)
@@ -978,51 +1575,47 @@ class Account:
     async def _sign(self, tx):
         inputs = tx.inputs()
 
-        for input_index, input in enumerate(inputs):
-            signature = await self._sign_input(tx, input, input_index)
-
-            public_key = self._get_public_key(input)
-
-            script = bc.Script.from_ops([
-                bc.Operation.from_data(signature),
-                bc.Operation.from_data(public_key)
-            ])
-
-            assert bc.Script.is_sign_key_hash_pattern(script.operations())
+        # Look up every prevout and key up front, then sign in parallel.
+        jobs = self._signing_jobs(inputs)
+        loop = asyncio.get_event_loop()
+        executor = self._get_signing_executor()
+        threads = self._settings.signing_threads
+        chunks = [jobs[i::threads] for i in range(threads)]
+        results = await asyncio.gather(*[
+            loop.run_in_executor(executor, _sign_inputs, tx, chunk)
+            for chunk in chunks if chunk])
+        scripts = {}
+        for chunk_scripts in results:
+            scripts.update(chunk_scripts)
 
-            input.set_script(script)
+        for input_index, input in enumerate(inputs):
+            input.set_script(scripts[input_index])
 
         tx.set_inputs(inputs)
 
-    async def _sign_input(self, tx, input, input_index):
-        prevout_script = self._get_prevout_script(input)
-
-        # Secret.
-        secret = self._get_secret(prevout_script)
-
-        return bc.Script.create_endorsement(
-            secret, prevout_script, tx, input_index, bc.SighashAlgorithm.all)
-
-    def _get_prevout_script(self, input):
-        # Find tx and output.
-        previous_output_point = input.previous_output()
-        tx_hash, previous_index = (previous_output_point.hash(),
-                                   previous_output_point.index())
-        previous_tx = self._model.cache.transactions[tx_hash]
-        # Address from output.
-        previous_output = previous_tx.outputs()[previous_index]
-        prevout_script = previous_output.script()
-        return prevout_script
-
-    def _get_secret(self, prevout_script):
-        # Get key for that address.
-        address = self._extract(prevout_script)
-        return self._model.find_key(address)
-
-    def _get_public_key(self, input):
-        prevout_script = self._get_prevout_script(input)
-        secret = self._get_secret(prevout_script)
-        return secret.to_public().data
+    def _signing_jobs(self, inputs):
+        points = [input.previous_output() for input in inputs]
+        transactions = self._model.cache.transactions.many(
+            [point.hash() for point in points])
+
+        prevout_scripts = []
+        for point in points:
+            previous_tx = transactions[bc.encode_hash(point.hash())]
+            previous_output = previous_tx.outputs()[point.index()]
+            prevout_scripts.append(previous_output.script())
+
+        jobs = []
+        for input_index, prevout_script in enumerate(prevout_scripts):
+            entry = self._model.keys.get(self._extract(prevout_script))
+            jobs.append((input_index, entry.secret, entry.public_key,
+                         prevout_script))
+        return jobs
+
+    def _get_signing_executor(self):
+        if self._signing_executor is None:
+            self._signing_executor = concurrent.futures.ThreadPoolExecutor(
+                self._settings.signing_threads)
+        return self._signing_executor
 
     def _extract(self, prevout_script):
         p2kh = bc.PaymentAddress.mainnet_p2kh
@@ -1032,9 +1625,17 @@ class Account:
             p2sh = bc.PaymentAddress.testnet_p2sh
         return bc.PaymentAddress.extract(prevout_script, p2kh, p2sh)
 
-    def _save_pending_transaction(self, dests, tx, from_pocket):
+    def _save_pending_transaction(self, dests, tx, from_pocket,
+                                  payouts=None):
         pocket = self._model.pocket(from_pocket)
-        self._model.save_pending_transaction(dests, tx, pocket)
+        with db.db.atomic():
+            next_broadcast = datetime.datetime.now() + datetime.timedelta(
+                seconds=self._settings.rebroadcast_interval)
+            self._model.save_pending_transaction(dests, tx, pocket,
+                                                 next_broadcast)
+            # Dequeue along with recording the payment.
+            if payouts:
+                self._model.remove_queued_payouts(payouts)
 
     def pending_payments(self, pocket_name):
         if pocket_name is None:
@@ -1056,12 +1657,28 @@ class Account:
             "tx_hash": bc.encode_hash(payment.tx_hash),
             "created_date": payment.created_date.strftime("%d %b %Y"),
             "destinations": [
-                (address, decimal_to_satoshi(value)) for address, value
+                (address, value) for address, value
                 in payment.destinations
                 ],
             "fee": payment.transaction.fees()
             } for payment in pending_payments]
 
+def _sign_inputs(tx, jobs):
+    # Runs in the signing threads. libbitcoin releases the GIL
+    # whilst signing.
+    scripts = {}
+    for input_index, secret, public_key, prevout_script in jobs:
+        signature = bc.Script.create_endorsement(
+            secret, prevout_script, tx, input_index, bc.SighashAlgorithm.all)
+
+        script = bc.Script.from_ops([
+            bc.Operation.from_data(signature),
+            bc.Operation.from_data(public_key)
+        ])
+        assert bc.Script.is_sign_key_hash_pattern(script.operations())
+        scripts[input_index] = script
+    return scripts
+
 def create_brainwallet_seed():
     entropy = os.urandom(16)
     return bc.create_mnemonic(entropy)
@@ -1074,11 +1691,22 @@ class Wallet:
 
         self._init_accounts_path()
         self._account_names = darkwallet.util.list_files(self.accounts_path)
+        # Open accounts ordered from least to most recently used.
+        self._accounts = collections.OrderedDict()
         self._account = None
 
+        # One client per network, shared by all open accounts.
+        self._clients = {}
+
     def stop(self):
-        if self._account is not None:
-            self._account.stop()
+        for account in self._accounts.values():
+            account.stop()
+
+    def _client(self, is_testnet):
+        if is_testnet not in self._clients:
+            self._clients[is_testnet] = darkwallet.blockchain.connect(
+                self._context, self._settings, is_testnet)
+        return self._clients[is_testnet]
 
     @property
     def accounts_path(self):
@@ -1090,166 +1718,265 @@ class Wallet:
     def account_filename(self, account_name):
         return os.path.join(self.accounts_path, account_name)
 
+    def _open_account(self, account):
+        self._accounts[account.name] = account
+        self._account = account
+
+        # Close the least recently used accounts over the limit.
+        while len(self._accounts) > self._settings.max_open_accounts:
+            account_name, evicted = self._accounts.popitem(last=False)
+            logger.info("Closing account: %s", account_name)
+            evicted.stop()
+
+    def _close_account(self, account_name):
+        account = self._accounts.pop(account_name, None)
+        if account is None:
+            return
+        account.stop()
+        if account is self._account:
+            self._account = None
+
+    def _get_account(self, account_name=None):
+        if account_name is None:
+            account = self._account
+            if account is None:
+                return ErrorCode.no_active_account_set, None
+        else:
+            account = self._accounts.get(account_name)
+            if account is None:
+                return ErrorCode.account_not_open, None
+
+        self._accounts.move_to_end(account.name)
+        account.activate()
+        return None, account
+
     async def create_account(self, account_name, password, is_testnet):
-        print("Create_account:", account_name, password)
+        # Never log the password or the wordlist.
+        logger.info("Creating account: %s", account_name)
         if account_name in self._account_names:
             return ErrorCode.duplicate, []
 
         # Create new seed
         wordlist = create_brainwallet_seed()
-        print("Wordlist:", wordlist)
-
-        if self._account is not None:
-            self._account.stop()
 
         account_filename = self.account_filename(account_name)
-        # Init current account object
-        self._account = Account(account_name, account_filename,
-                                self._context, self._settings)
+        # Init new account object
+        account = Account(account_name, account_filename,
+                          self._context, self._settings)
 
-        self._account.initialize_db(account_filename, password)
-        ec = self._account.create(wordlist, is_testnet)
+        account.initialize_db(account_filename, password)
+        ec = account.create(wordlist, is_testnet)
         if ec:
-            self._account = None
             return ec, []
 
         # Create master pocket
-        ec = self._account.create_pocket(self._settings.master_pocket_name)
+        ec = account.create_pocket(self._settings.master_pocket_name)
         assert ec is None
 
         self._account_names.append(account_name)
-        self._account.start_scanning()
+        account.start_scanning(self._client(account.is_testnet))
+        self._open_account(account)
 
         return None, []
 
-    async def seed(self):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        return None, self._account.brainwallet_wordlist()
+    async def seed(self, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return None, account.brainwallet_wordlist()
 
     async def restore_account(self, account_name, wordlist,
                               password, is_testnet):
-        print("Restore_account:", account_name, wordlist, password)
+        logger.info("Restoring account: %s", account_name)
         if account_name in self._account_names:
             return ErrorCode.duplicate, []
 
         if not bc.validate_mnemonic(wordlist):
             return ErrorCode.invalid_brainwallet, []
 
-        if self._account is not None:
-            self._account.stop()
-
         account_filename = self.account_filename(account_name)
-        # Init current account object
-        self._account = Account(account_name, account_filename,
-                                self._context, self._settings)
+        # Init new account object
+        account = Account(account_name, account_filename,
+                          self._context, self._settings)
 
-        self._account.initialize_db(account_filename, password)
-        ec = self._account.create(wordlist, is_testnet)
+        account.initialize_db(account_filename, password)
+        ec = account.create(wordlist, is_testnet)
         if ec:
-            self._account = None
             return ec, []
 
         # Create master pocket
-        ec = self._account.create_pocket(self._settings.master_pocket_name)
+        ec = account.create_pocket(self._settings.master_pocket_name)
         assert ec is None
 
         self._account_names.append(account_name)
-        self._account.start_scanning()
+        account.start_restore(self._client(account.is_testnet))
+        self._open_account(account)
 
         return None, []
 
-    async def balance(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        return self._account.balance(pocket)
+    async def restore_status(self, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec, status = account.restore_status()
+        if ec:
+            return ec, []
+        return None, [status]
+
+    async def balance(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return account.balance(pocket)
+
+    async def history(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return account.history(pocket)
+
+    async def export_history(self, pocket, format, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, None
+        return account.export_history(pocket, format)
 
-    async def history(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        return self._account.history(pocket)
+    async def export_history_to_file(self, pocket, format, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec, filename = await account.export_history_to_file(pocket, format)
+        return ec, [filename]
 
     async def list_accounts(self):
         account_name = None if self._account is None else self._account.name
         return None, [account_name, self._account_names]
 
+    async def list_open_accounts(self):
+        return None, [list(self._accounts)]
+
     async def set_account(self, account_name, password):
         if not account_name in self._account_names:
             return ErrorCode.not_found, []
 
-        if self._account is not None:
-            self._account.stop()
+        # Already open, so just make it the active account.
+        if account_name in self._accounts:
+            account = self._accounts[account_name]
+            if not account.check_password(password):
+                return ErrorCode.wrong_password, []
+            self._open_account(account)
+            return None, []
 
         account_filename = self.account_filename(account_name)
-        # Init current account object
-        self._account = Account(account_name, account_filename,
-                                self._context, self._settings)
+        # Init new account object
+        account = Account(account_name, account_filename,
+                          self._context, self._settings)
 
-        self._account.initialize_db(account_filename, password)
-        if not self._account.load():
-            self._account = None
+        account.initialize_db(account_filename, password)
+        if not account.load():
+            account.stop()
             return ErrorCode.wrong_password, []
 
-        self._account.start_scanning()
+        account.start_scanning(self._client(account.is_testnet))
+        self._open_account(account)
+        return None, []
+
+    async def close_account(self, account_name):
+        if not account_name in self._accounts:
+            return ErrorCode.account_not_open, []
+        self._close_account(account_name)
         return None, []
 
     async def delete_account(self, account_name):
         if not account_name in self._account_names:
             return ErrorCode.not_found, []
-        if self._account is not None and self._account.name == account_name:
-            self._account = None
+        self._close_account(account_name)
         self._account_names.remove(account_name)
         account_filename = self.account_filename(account_name)
         os.remove(account_filename)
         return None, []
 
-    async def list_pockets(self):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        return None, [self._account.list_pockets()]
+    async def list_pockets(self, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return None, [account.list_pockets()]
 
-    async def create_pocket(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        ec = self._account.create_pocket(pocket)
+    async def create_pocket(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec = account.create_pocket(pocket)
         self._settings.save()
         return ec, []
 
-    async def delete_pocket(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        ec = self._account.delete_pocket(pocket)
+    async def delete_pocket(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec = account.delete_pocket(pocket)
         self._settings.save()
         return ec, []
 
-    async def send(self, dests, from_pocket, fee):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
+    async def send(self, dests, from_pocket, fee, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        dests = [(addr, int(amount)) for addr, amount in dests]
+        ec, tx_hash = await account.send(dests, from_pocket, fee)
+        return ec, [tx_hash]
+
+    async def queue_payment(self, dests, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
         dests = [(addr, int(amount)) for addr, amount in dests]
-        ec, tx_hash = await self._account.send(dests, from_pocket, fee)
+        return account.queue_payment(dests, pocket)
+
+    async def queued_payments(self, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return account.queued_payments()
+
+    async def flush_payments(self, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return await account.flush_payouts(force=True)
+
+    async def consolidate(self, pocket, fee_rate=None, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec, tx_hash = await account.consolidate(pocket, fee_rate)
         return ec, [tx_hash]
 
-    async def pending_payments(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        return self._account.pending_payments(pocket)
+    async def pending_payments(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        return account.pending_payments(pocket)
 
-    async def receive(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        ec, addresses = self._account.receive(pocket)
+    async def receive(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec, addresses = account.receive(pocket)
         return ec, addresses
 
-    async def stealth(self, pocket):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        ec, stealth_address = self._account.stealth(pocket)
+    async def stealth(self, pocket, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec, stealth_address = account.stealth(pocket)
         return ec, [stealth_address]
 
-    async def get_height(self):
-        if self._account is None:
-            return ErrorCode.no_active_account_set, []
-        ec, height = await self._account.get_height()
+    async def get_height(self, account_name=None):
+        ec, account = self._get_account(account_name)
+        if ec:
+            return ec, []
+        ec, height = await account.get_height()
         return ec, [height]
 
     async def get_setting(self, name):
@@ -1259,6 +1986,11 @@ class Wallet:
             return ErrorCode.not_found, []
         return None, [value]
 
+    async def trace(self, count, kinds, profile):
+        directory = tracing.directory(self._settings)
+        tracing.tracer.enable(directory, count, kinds, profile)
+        return None, [directory]
+
     async def set_setting(self, name, value):
         try:
             setattr(self._settings, name, value)
@@ -1,64 +1,171 @@
 import asyncio
-import sys
+import logging
 import time
-import traceback
 
 import libbitcoin.server
 from libbitcoin import bc
+import darkwallet.metrics as metrics
+import darkwallet.tracing as tracing
+
+logger = logging.getLogger(__name__)
+
+class InteractiveRequests:
+
+    # Counts RPC requests in flight. Background work pauses at its
+    # checkpoints until they finish, for at most max_pause seconds so
+    # a busy daemon still syncs.
+
+    max_pause = 0.5
+
+    def __init__(self):
+        self._active = 0
+        self._waiters = []
+
+    def __enter__(self):
+        self._active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._active -= 1
+        if not self._active:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._waiters = []
+        return False
+
+    async def wait_idle(self):
+        if not self._active:
+            return
+        waiter = asyncio.Future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_pause)
+        except asyncio.TimeoutError:
+            pass
+
+interactive = InteractiveRequests()
+
+class Budget:
+
+    # What one process may spend in a single tick. Processes check
+    # is_exhausted between units of work and leave the rest for the
+    # next tick.
+
+    def __init__(self, seconds, queries):
+        self._deadline = time.time() + seconds
+        self.queries_left = queries
+
+    def charge(self, count=1):
+        self.queries_left -= count
+
+    @property
+    def is_exhausted(self):
+        return self.queries_left <= 0 or time.time() > self._deadline
 
 class WalletControlProcess:
 
-    def __init__(self, client, model, settings):
+    # Seconds between ticks when there's no work left over.
+    _interval = 5
+
+    def __init__(self, client, model, settings, account):
+        self._settings = settings
+        history = ScanHistoryProcess(self, client, model)
         self._procs = [
             QueryBlockchainReorganizationProcess(self, client, model),
             ScanStealthProcess(self, client, model),
-            ScanHistoryProcess(self, client, model),
+            history,
             MarkSentPaymentsConfirmedProcess(self, client, model),
             FillCacheProcess(self, client, model),
-            GenerateKeysProcess(self, client, model, settings),
-            RebroadcastProcess(self, client, model)
+            GenerateKeysProcess(self, client, model, settings, history),
+            RebroadcastProcess(self, client, model, settings),
+            PayoutProcess(self, client, model, settings, account)
+        ]
+        reorg, stealth, history, confirmed, fill, keys, rebroadcast, \
+            payout = self._procs
+        # Each stage needs what the ones before it wrote. Processes
+        # within a stage run concurrently.
+        self._stages = [
+            [reorg],
+            [history, stealth],
+            [keys, fill, confirmed],
+            [rebroadcast, payout]
         ]
 
-    def wakeup_processes(self):
-        [process.wakeup() for process in self._procs]
+        loop = asyncio.get_event_loop()
+        self._task = loop.create_task(self._run())
 
     def stop(self):
-        [process.stop() for process in self._procs]
+        self._task.cancel()
+
+    async def _run(self):
+        tracing.detach()
+        while True:
+            for stage in self._stages:
+                await asyncio.gather(*[self._run_process(process)
+                                       for process in stage])
+
+            if any(process.has_more_work for process in self._procs):
+                # Carry on straight away, after anything else waiting.
+                await asyncio.sleep(0)
+                continue
+
+            await asyncio.sleep(self._interval)
+
+    async def _run_process(self, process):
+        name = type(process).__name__
+        process.budget = Budget(self._settings.process_time_budget,
+                                self._settings.process_query_budget)
+        process.has_more_work = False
+        await interactive.wait_idle()
+        start = time.time()
+        try:
+            with tracing.cycle(name):
+                await process.update()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Don't hold up the others. It runs again next tick.
+            logger.exception("%s failed.", name)
+        metrics.process_update.observe(time.time() - start, name)
+
+class _BudgetedClient:
+
+    # Charges every query a process makes to its budget.
+
+    def __init__(self, client, process):
+        self._client = client
+        self._process = process
+
+    def supports(self, command):
+        return self._client.supports(command)
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        def query(*args):
+            if self._process.budget is not None:
+                self._process.budget.charge()
+            return method(*args)
+        return query
 
 class BaseProcess:
 
     def __init__(self, parent, client, model):
         self.parent = parent
-        self.client = client
+        self.client = _BudgetedClient(client, self)
         self.model = model
 
-        self._wakeup_future = asyncio.Future()
-        self._start()
+        self.budget = None
+        self.has_more_work = False
 
-    def _start(self):
-        loop = asyncio.get_event_loop()
-        self._task = loop.create_task(self._run())
-
-    def stop(self):
-        self._task.cancel()
-
-    def wakeup(self):
-        if not self._wakeup_future.done():
-            self._wakeup_future.set_result(None)
-
-    async def _run(self):
-        while True:
-            try:
-                await self.update()
-            except:
-                traceback.print_exc()
-                raise
-
-            self._wakeup_future = asyncio.Future()
-            try:
-                await asyncio.wait_for(self._wakeup_future, 5)
-            except asyncio.TimeoutError:
-                pass
+    async def checkpoint(self):
+        # Lets waiting RPC requests go first. Returns whether this
+        # tick's budget allows more work.
+        await interactive.wait_idle()
+        if self.budget is not None and self.budget.is_exhausted:
+            self.has_more_work = True
+            return False
+        return True
 
     async def update(self):
         pass
@@ -81,32 +188,29 @@ class QueryBlockchainReorganizationProcess(BaseProcess):
         if self.model.compare_indexes(index):
             # Nothing changed.
             return
-        print("Current height:", self.model.current_height)
-        print("Latest height:", last_height)
+        logger.debug("Current height: %s, latest height: %s",
+                     self.model.current_height, last_height)
 
         if self.model.current_index is None:
-            print("Initializing new chain state.")
+            logger.info("Initializing new chain state.")
         elif header.previous_block_hash == self.model.current_hash:
-            print("New single block added.")
+            logger.info("New single block added.")
         elif await self._index_is_connected(index):
-            print("Several new blocks added.")
+            logger.info("Several new blocks added.")
         else:
-            print("Blockchain reorganization event.")
+            logger.warning("Blockchain reorganization event.")
             self._invalidate_records()
 
         self._record(index)
 
-        # Wakeup the other processes.
-        self.parent.wakeup_processes()
-
     async def _query_blockchain_head(self):
         ec, height = await self.client.last_height()
         if ec:
-            print("Error: querying last_height:", ec, file=sys.stderr)
+            logger.error("Querying last_height: %s", ec)
             return None
         ec, header = await self.client.block_header(height)
         if ec:
-            print("Error: querying header:", ec, file=sys.stderr)
+            logger.error("Querying header: %s", ec)
             return None
         header = bc.Header.from_data(header)
         return height, header
@@ -115,25 +219,24 @@ class QueryBlockchainReorganizationProcess(BaseProcess):
         # To avoid long rewinds, if we recurse too much
         # just treat it as a reorganization event.
         if current_recursions > self._max_rewind_depth:
-            print("Exceeded max rewind depth.")
+            logger.info("Exceeded max rewind depth.")
             return False
 
         height, hash_ = index
-        print("Rewinding from:", index)
+        logger.debug("Rewinding from: %s", index)
 
         if height <= self.model.current_height:
-            print("Rewinded past current index.")
+            logger.debug("Rewinded past current index.")
             return False
 
         ec, header = await self.client.block_header(height)
         if ec:
-            print("Error: querying header:", ec, file=sys.stderr)
+            logger.error("Querying header: %s", ec)
             return False
         header = bc.Header.from_data(header)
 
         if header.hash() != hash_:
-            print("Error: non-matching header and index hash.",
-                  file=sys.stderr)
+            logger.error("Non-matching header and index hash.")
             return False
 
         # Try to link this block with the current recorded hash.
@@ -151,11 +254,10 @@ class QueryBlockchainReorganizationProcess(BaseProcess):
     # ------------------------------------------------
 
     def _invalidate_records(self):
-        print("Invalidating records...")
+        logger.info("Invalidating records...")
         self._clear_history()
-        print("Cleared history.")
         self._nullify_address_updated_heights()
-        print("Reset address updated heights.")
+        logger.info("Cleared history and reset address updated heights.")
 
     def _clear_history(self):
         self.model.cache.history.clear()
@@ -168,7 +270,7 @@ class QueryBlockchainReorganizationProcess(BaseProcess):
     # ------------------------------------------------
 
     def _record(self, index):
-        print("Updating current_index to:", index)
+        logger.debug("Updating current_index to: %s", index)
         self.model.current_index = index
 
 class ScanStealthProcess(BaseProcess):
@@ -212,11 +314,10 @@ class ScanStealthProcess(BaseProcess):
         from_height = max(genesis_height, from_height)
         # We haven't implemented prefixes yet.
         prefix = libbitcoin.server.Binary(0, b"")
-        print("Starting stealth query. [from_height=%s]" % from_height)
+        logger.debug("Starting stealth query. [from_height=%s]", from_height)
         ec, rows = await self.client.stealth(prefix, from_height)
-        print("Stealth query done.")
         if ec:
-            print("Error: query stealth:", ec, file=sys.stderr)
+            logger.error("Query stealth: %s", ec)
             return
         for ephemkey, address_hash, tx_hash in rows:
             ephemeral_public = bytes([2]) + ephemkey[::-1]
@@ -245,7 +346,7 @@ class ScanStealthProcess(BaseProcess):
         if derived_address is None or original_address != derived_address:
             return
         assert original_address == derived_address
-        print("Found match:", derived_address)
+        logger.info("Found stealth payment to: %s", derived_address)
 
         private_key = receiver.derive_private(ephemeral_public)
         pocket.add_stealth_key(original_address, private_key)
@@ -260,6 +361,8 @@ class ScanStealthProcess(BaseProcess):
 
 class ScanHistoryProcess(BaseProcess):
 
+    _batch_size = 100
+
     @property
     def _tracker(self):
         return self.model.cache.track_address_updates
@@ -268,34 +371,51 @@ class ScanHistoryProcess(BaseProcess):
         if self.model.current_height is None:
             return
 
-        tasks = []
+        self._lag = 0
+        pending = []
         for pocket in self.model.pockets:
-            tasks += [
-                self._process(address, pocket) for address in pocket.addrs
-            ]
-
-        # Remove all the None values
-        tasks = [task for task in tasks if task is not None]
-
-        await asyncio.gather(*tasks)
-
-    def _process(self, address, pocket):
+            for address in pocket.addrs:
+                from_height = self._from_height(address)
+                if from_height is not None:
+                    pending.append((address, from_height, pocket))
+        metrics.sync_lag.set(self._lag, self.model.name)
+
+        # Batches within this tick's query budget. The rest wait for
+        # the next tick.
+        while pending and await self.checkpoint():
+            size = min(self._batch_size, self.budget.queries_left)
+            batch, pending = pending[:size], pending[size:]
+            await asyncio.gather(*[self._scan(*args) for args in batch])
+
+    def _from_height(self, address):
         from_height = self._tracker.last_updated_height(address)
 
         if from_height == self.model.current_height:
             return None
         assert from_height < self.model.current_height
+        self._lag = max(self._lag,
+                        self.model.current_height - (from_height or 0))
+        return from_height
 
-        coroutine = self._scan(address, from_height, pocket)
-        return coroutine
-
-    async def _scan(self, address, from_height, pocket):
-        ec, history = await self.client.history(address.encoded())
+    async def scan_addresses(self, addresses, pocket, client):
+        # For new keys, which can't wait for the next tick. The
+        # queries go through the caller's client and its budget.
+        if self.model.current_height is None:
+            return
+        for i in range(0, len(addresses), self._batch_size):
+            batch = addresses[i:i + self._batch_size]
+            await asyncio.gather(*[self._scan(address, 0, pocket, client)
+                                   for address in batch])
+
+    async def _scan(self, address, from_height, pocket, client=None):
+        if client is None:
+            client = self.client
+        ec, history = await client.history(address.encoded())
         if ec:
-            print("Couldn't fetch history:", ec, file=sys.stderr)
+            logger.warning("Couldn't fetch history: %s", ec)
             return
 
-        print("Fetched history for", address)
+        logger.debug("Fetched history for %s", address)
 
         self._set_history(address, history, pocket)
 
@@ -311,7 +431,9 @@ class ScanHistoryProcess(BaseProcess):
 class MarkSentPaymentsConfirmedProcess(BaseProcess):
 
     async def update(self):
-        self.model.mark_any_confirmed_sent_payments()
+        count = self.model.mark_any_confirmed_sent_payments()
+        if count:
+            logger.info("Marked %s sent payments confirmed.", count)
 
 class FillCacheProcess(BaseProcess):
 
@@ -320,78 +442,166 @@ class FillCacheProcess(BaseProcess):
 
     async def _fill_cache(self):
         for tx_hash in self.model.cache.history.transaction_hashes:
-            if not tx_hash in self.model.cache.transactions:
-                await self._grab_tx(tx_hash)
+            if tx_hash in self.model.cache.transactions:
+                continue
+            if not await self.checkpoint():
+                return
+            await self._grab_tx(tx_hash)
 
     async def _grab_tx(self, tx_hash):
         ec, tx_data = await self.client.transaction(tx_hash.data)
         if ec:
-            print("Couldn't fetch transaction:", ec, file=sys.stderr)
+            logger.warning("Couldn't fetch transaction: %s", ec)
             return
-        print("Got tx:", tx_hash)
+        logger.debug("Got tx: %s", tx_hash)
         tx = bc.Transaction.from_data(tx_data)
         self.model.cache.transactions[tx_hash] = tx
 
 class GenerateKeysProcess(BaseProcess):
 
-    def __init__(self, parent, client, model, settings):
+    def __init__(self, parent, client, model, settings, history):
         super().__init__(parent, client, model)
 
         self._settings = settings
+        self._history = history
 
     async def update(self):
         await self._generate_keys()
 
     async def _generate_keys(self):
         for pocket in self.model.pockets:
-            self._generate_pocket_keys(pocket)
+            await self._extend_pocket(pocket)
+
+    async def _extend_pocket(self, pocket):
+        # Scan new keys straight away. Any of them found used moves
+        # the gap along, so carry on until the gap limit holds.
+        addresses = self._generate_pocket_keys(pocket)
+        while addresses:
+            if not await self.checkpoint():
+                return
+            await self._history.scan_addresses(addresses, pocket,
+                                               self.client)
+            addresses = self._generate_pocket_keys(pocket)
 
     def _generate_pocket_keys(self, pocket):
-        max_i = -1
-        for address in pocket.addrs:
-            if address not in self.model.cache.history:
-                continue
-            i = pocket.address_index(address)
-            if i is None:
-                continue
-            max_i = max(i, max_i)
+        max_i = pocket.max_used_index()
         desired_len = max_i + 1 + self._settings.gap_limit
         # If we clear history and our view is incomplete
         # then we may have more keys then we expect already.
-        if pocket.number_normal_keys() >= desired_len:
-            return
-        remaining = desired_len - pocket.number_normal_keys()
-        assert remaining > 0
-        for i in range(remaining):
-            pocket.add_key()
-        print("Generated %s keys" % remaining)
+        number_keys = pocket.number_normal_keys()
+        if number_keys >= desired_len:
+            return []
+        remaining = desired_len - number_keys
+        addresses = pocket.add_keys(remaining)
+        logger.debug("Generated %s keys", remaining)
+        return addresses
 
 class RebroadcastProcess(BaseProcess):
 
-    def __init__(self, parent, client, model):
+    # Each pending payment has its own schedule. When one is due the
+    # server is asked whether its pool still has the transaction, and
+    # only if not is it sent again, waiting twice as long each time up to
+    # the maximum interval.
+
+    _batch_size = 100
+
+    def __init__(self, parent, client, model, settings):
         super().__init__(parent, client, model)
 
-        self._last_time = None
+        self._interval = settings.rebroadcast_interval
+        self._max_interval = settings.rebroadcast_max_interval
+        self._concurrency = settings.rebroadcast_concurrency
 
-    def _elapsed_time(self):
-        return time.time() - self._last_time if self._last_time else None
+    def _delay(self, broadcast_attempts):
+        exponent = min(max(broadcast_attempts - 1, 0), 32)
+        return min(self._interval * 2 ** exponent, self._max_interval)
 
     async def update(self):
-        elapsed_time = self._elapsed_time()
+        semaphore = asyncio.Semaphore(self._concurrency)
+        while not self.budget.is_exhausted:
+            payments = self.model.due_rebroadcasts(self._batch_size)
+            await asyncio.gather(*[self._rebroadcast(payment, semaphore)
+                                   for payment in payments])
+            if len(payments) < self._batch_size:
+                return
+        self.has_more_work = True
+
+    async def _rebroadcast(self, payment, semaphore):
+        async with semaphore:
+            if await self._is_in_pool(payment.tx_hash):
+                result = "in_pool"
+            else:
+                result = await self._broadcast(payment.transaction)
+        metrics.rebroadcasts.inc(result)
+        logger.debug("Rebroadcast %s: %s [attempts=%s]",
+                     payment.tx_hash, result, payment.broadcast_attempts)
+
+        if result == "sent":
+            metrics.rebroadcast_attempts.observe(payment.broadcast_attempts)
+            payment.schedule_broadcast(
+                self._delay(payment.broadcast_attempts + 1), broadcast=True)
+        else:
+            payment.schedule_broadcast(
+                self._delay(payment.broadcast_attempts))
+
+    async def _is_in_pool(self, tx_hash):
+        # Asked fresh every time, never from the caches, so a
+        # transaction dropped from the pool gets noticed. Payments in
+        # a block were already marked confirmed from the history
+        # earlier in this tick and aren't due.
+        if not self.client.supports("transaction_pool_transaction"):
+            return False
+        ec, _ = await self.client.transaction_pool_transaction(tx_hash.data)
+        return not ec
 
-        rebroadcast_time = 20 * 60
+    async def _broadcast(self, tx):
+        tx_data = tx.to_data()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Rebroadcasting: %s", tx_data.hex())
+        ec = await self.client.broadcast(tx_data)
+        if ec:
+            logger.warning("Rebroadcasting %s: %s", tx.hash(), ec)
+            return "error"
+        return "sent"
 
-        if elapsed_time is None or elapsed_time > rebroadcast_time:
-            await self._rebroadcast()
+class PayoutProcess(BaseProcess):
 
-            self._last_time = time.time()
+    def __init__(self, parent, client, model, settings, account):
+        super().__init__(parent, client, model)
 
-    async def _rebroadcast(self):
-        payments = self.model.all_pending_payments()
-        for tx in [payment.transaction for payment in payments]:
-            await self._broadcast(tx)
+        self._settings = settings
+        self._account = account
+        self._last_consolidate_time = None
 
-    async def _broadcast(self, tx):
-        print("Broadcasting:", tx.to_data().hex())
-        ec = await self.client.broadcast(tx.to_data())
+    def _consolidate_elapsed_time(self):
+        if self._last_consolidate_time is None:
+            return None
+        return time.time() - self._last_consolidate_time
 
+    async def update(self):
+        await self._account.flush_payouts()
+
+        if self._settings.consolidate_fee_rate <= 0:
+            return
+        # Only sweep when nothing is waiting to go out.
+        if self.model.queued_payouts():
+            return
+        elapsed_time = self._consolidate_elapsed_time()
+        if (elapsed_time is not None and
+                elapsed_time < self._settings.consolidate_interval):
+            return
+        await self._consolidate()
+        self._last_consolidate_time = time.time()
+
+    async def _consolidate(self):
+        for pocket_name in self.model.pocket_names:
+            count = self._account.consolidation_count(pocket_name)
+            if count < self._settings.consolidate_min_inputs:
+                continue
+            ec, tx_hash = await self._account.consolidate(
+                pocket_name, self._settings.consolidate_fee_rate)
+            if ec:
+                logger.error("Consolidating %s: %s", pocket_name, ec)
+                continue
+            logger.info("Consolidated %s outputs in %s: %s",
+                        count, pocket_name, tx_hash)
@@ -1,7 +1,14 @@
-import sys
+import logging
+import time
 
+import darkwallet.metrics as metrics
+import darkwallet.tracing as tracing
 import darkwallet.wallet
+from darkwallet.wallet_control import interactive
 from darkwallet.address_validator import AddressValidator, AddressType
+from darkwallet.address_validator import validate_addresses
+
+logger = logging.getLogger(__name__)
 
 class WalletInterfaceCallback:
 
@@ -17,8 +24,9 @@ class WalletInterfaceCallback:
 
     async def query(self):
         if not self.initialize(self._params):
-            print("Error: bad parameters specified:",
-                  self._params, file=sys.stderr)
+            # Parameters can hold passwords, so they aren't logged.
+            logger.warning("Bad parameters specified for %s.",
+                           self._request["command"])
             return None
         ec, result = await self.make_query()
         return self._response(ec, result)
@@ -29,6 +37,10 @@ class WalletInterfaceCallback:
     @property
     def _params(self):
         return self._request["params"]
+    @property
+    def _account_name(self):
+        # Optional target account, otherwise the active one is used.
+        return self._request.get("account")
 
     def _response(self, ec, result):
         if ec is not None:
@@ -60,7 +72,7 @@ class DwSeed(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.seed()
+        return await self._wallet.seed(account_name=self._account_name)
 
 class DwRestoreAccount(WalletInterfaceCallback):
 
@@ -75,6 +87,15 @@ class DwRestoreAccount(WalletInterfaceCallback):
         return await self._wallet.restore_account(self._account,
             self._brainwallet, self._password, self._is_testnet)
 
+class DwRestoreStatus(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        return not params
+
+    async def make_query(self):
+        return await self._wallet.restore_status(
+            account_name=self._account_name)
+
 class DwBalance(WalletInterfaceCallback):
 
     def initialize(self, params):
@@ -84,7 +105,8 @@ class DwBalance(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.balance(self._pocket)
+        return await self._wallet.balance(
+            self._pocket, account_name=self._account_name)
 
 class DwHistory(WalletInterfaceCallback):
 
@@ -95,7 +117,48 @@ class DwHistory(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.history(self._pocket)
+        return await self._wallet.history(
+            self._pocket, account_name=self._account_name)
+
+class DwExportHistory(WalletInterfaceCallback):
+
+    # Sent back over several responses. All but the last one have
+    # "more" set.
+    is_streaming = True
+
+    def initialize(self, params):
+        if len(params) != 3:
+            return False
+        self._pocket, self._format, self._to_file = params
+        return True
+
+    async def make_query(self):
+        return await self._wallet.export_history_to_file(
+            self._pocket, self._format, account_name=self._account_name)
+
+    async def stream(self):
+        if not self.initialize(self._params):
+            logger.warning("Bad parameters specified for %s.",
+                           self._request["command"])
+            # The client waits on the id until it gets an answer.
+            yield self._response(darkwallet.wallet.ErrorCode.bad_parameters,
+                                 None)
+            return
+        if self._to_file:
+            ec, result = await self.make_query()
+            yield self._response(ec, result)
+            return
+
+        ec, chunks = await self._wallet.export_history(
+            self._pocket, self._format, account_name=self._account_name)
+        if ec:
+            yield self._response(ec, [])
+            return
+        for chunk in chunks:
+            response = self._response(None, [chunk])
+            response["more"] = True
+            yield response
+        yield self._response(None, [])
 
 class DwListAccounts(WalletInterfaceCallback):
 
@@ -116,6 +179,25 @@ class DwSetAccount(WalletInterfaceCallback):
     async def make_query(self):
         return await self._wallet.set_account(self._account, self._password)
 
+class DwListOpenAccounts(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        return not params
+
+    async def make_query(self):
+        return await self._wallet.list_open_accounts()
+
+class DwCloseAccount(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        if len(params) != 1:
+            return False
+        self._account = params[0]
+        return True
+
+    async def make_query(self):
+        return await self._wallet.close_account(self._account)
+
 class DwDeleteAccount(WalletInterfaceCallback):
 
     def initialize(self, params):
@@ -133,7 +215,8 @@ class DwListPockets(WalletInterfaceCallback):
         return not params
 
     async def make_query(self):
-        return await self._wallet.list_pockets()
+        return await self._wallet.list_pockets(
+            account_name=self._account_name)
 
 class DwCreatePocket(WalletInterfaceCallback):
 
@@ -144,7 +227,8 @@ class DwCreatePocket(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.create_pocket(self._pocket)
+        return await self._wallet.create_pocket(
+            self._pocket, account_name=self._account_name)
 
 class DwDeletePocket(WalletInterfaceCallback):
 
@@ -155,7 +239,8 @@ class DwDeletePocket(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.delete_pocket(self._pocket)
+        return await self._wallet.delete_pocket(
+            self._pocket, account_name=self._account_name)
 
 class DwSend(WalletInterfaceCallback):
 
@@ -166,7 +251,50 @@ class DwSend(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.send(self._dests, self._pocket, self._fee)
+        return await self._wallet.send(self._dests, self._pocket, self._fee,
+                                       account_name=self._account_name)
+
+class DwQueuePayment(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        if len(params) != 2:
+            return False
+        self._dests, self._pocket = params
+        return True
+
+    async def make_query(self):
+        return await self._wallet.queue_payment(
+            self._dests, self._pocket, account_name=self._account_name)
+
+class DwQueuedPayments(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        return not params
+
+    async def make_query(self):
+        return await self._wallet.queued_payments(
+            account_name=self._account_name)
+
+class DwFlushPayments(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        return not params
+
+    async def make_query(self):
+        return await self._wallet.flush_payments(
+            account_name=self._account_name)
+
+class DwConsolidate(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        if len(params) != 2:
+            return False
+        self._pocket, self._fee_rate = params
+        return True
+
+    async def make_query(self):
+        return await self._wallet.consolidate(
+            self._pocket, self._fee_rate, account_name=self._account_name)
 
 class DwPendingPayments(WalletInterfaceCallback):
 
@@ -177,7 +305,8 @@ class DwPendingPayments(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.pending_payments(self._pocket)
+        return await self._wallet.pending_payments(
+            self._pocket, account_name=self._account_name)
 
 class DwReceive(WalletInterfaceCallback):
 
@@ -188,7 +317,8 @@ class DwReceive(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.receive(self._pocket)
+        return await self._wallet.receive(
+            self._pocket, account_name=self._account_name)
 
 class DwStealth(WalletInterfaceCallback):
 
@@ -199,7 +329,8 @@ class DwStealth(WalletInterfaceCallback):
         return True
 
     async def make_query(self):
-        return await self._wallet.stealth(self._pocket)
+        return await self._wallet.stealth(
+            self._pocket, account_name=self._account_name)
 
 class DwValidateAddress(WalletInterfaceCallback):
 
@@ -213,13 +344,26 @@ class DwValidateAddress(WalletInterfaceCallback):
         validator = AddressValidator(self._addr)
         return None, [validator.type().name]
 
+class DwValidateAddresses(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        if len(params) != 1 or not isinstance(params[0], list):
+            return False
+        self._addrs = params[0]
+        return all(isinstance(addr, str) for addr in self._addrs)
+
+    async def make_query(self):
+        types = validate_addresses(self._addrs)
+        return None, [address_type.name for address_type in types]
+
 class DwGetHeight(WalletInterfaceCallback):
 
     def initialize(self, params):
         return not params
 
     async def make_query(self):
-        return await self._wallet.get_height()
+        return await self._wallet.get_height(
+            account_name=self._account_name)
 
 class DwGetSetting(WalletInterfaceCallback):
 
@@ -243,28 +387,57 @@ class DwSetSetting(WalletInterfaceCallback):
     async def make_query(self):
         return await self._wallet.set_setting(self._name, self._value)
 
+class DwTrace(WalletInterfaceCallback):
+
+    def initialize(self, params):
+        if not params or len(params) > 3:
+            return False
+        self._count = params[0]
+        self._kinds = params[1] if len(params) > 1 else None
+        self._profile = params[2] if len(params) > 2 else False
+        if self._kinds is None:
+            self._kinds = list(tracing.Tracer.kinds)
+        return (isinstance(self._count, int) and self._count >= 0 and
+                isinstance(self._kinds, list) and
+                all(kind in tracing.Tracer.kinds for kind in self._kinds) and
+                isinstance(self._profile, bool))
+
+    async def make_query(self):
+        return await self._wallet.trace(self._count, self._kinds,
+                                        self._profile)
+
 class WalletInterface:
 
     _handlers = {
         "dw_create_account":    DwCreateAccount,
         "dw_seed":              DwSeed,
         "dw_restore_account":   DwRestoreAccount,
+        "dw_restore_status":    DwRestoreStatus,
         "dw_balance":           DwBalance,
         "dw_history":           DwHistory,
+        "dw_export_history":    DwExportHistory,
         "dw_list_accounts":     DwListAccounts,
         "dw_set_account":       DwSetAccount,
+        "dw_list_open_accounts": DwListOpenAccounts,
+        "dw_close_account":     DwCloseAccount,
         "dw_delete_account":    DwDeleteAccount,
         "dw_list_pockets":      DwListPockets,
         "dw_create_pocket":     DwCreatePocket,
         "dw_delete_pocket":     DwDeletePocket,
         "dw_send":              DwSend,
+        "dw_queue_payment":     DwQueuePayment,
+        "dw_queued_payments":   DwQueuedPayments,
+        "dw_flush_payments":    DwFlushPayments,
+        "dw_consolidate":       DwConsolidate,
         "dw_pending_payments":  DwPendingPayments,
         "dw_receive":           DwReceive,
         "dw_stealth":           DwStealth,
         "dw_validate_address":  DwValidateAddress,
+        "dw_validate_addresses": DwValidateAddresses,
         "dw_get_height":        DwGetHeight,
         "dw_get_setting":       DwGetSetting,
-        "dw_set_setting":       DwSetSetting
+        "dw_set_setting":       DwSetSetting,
+        "dw_trace":             DwTrace
     }
 
     def __init__(self, context, settings):
@@ -282,5 +455,33 @@ class WalletInterface:
         assert command in self.commands
 
         handler = self._handlers[command](self._wallet, request)
-        return await handler.query()
+        start = time.time()
+        # Background syncing pauses whilst requests are answered.
+        with interactive, tracing.request(command):
+            response = await handler.query()
+        metrics.rpc_latency.observe(time.time() - start, command)
+        if response is None:
+            error = "bad_parameters"
+        else:
+            error = response["error"] or "none"
+        metrics.rpc_requests.inc(command, error)
+        return response
+
+    def is_streaming(self, request):
+        handler = self._handlers[request["command"]]
+        return getattr(handler, "is_streaming", False)
+
+    async def stream(self, request):
+        command = request["command"]
+        assert command in self.commands
+
+        handler = self._handlers[command](self._wallet, request)
+        start = time.time()
+        error = "none"
+        with interactive, tracing.request(command):
+            async for response in handler.stream():
+                error = response["error"] or error
+                yield response
+        metrics.rpc_latency.observe(time.time() - start, command)
+        metrics.rpc_requests.inc(command, error)
 